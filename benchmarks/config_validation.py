@@ -0,0 +1,53 @@
+"""
+Measures the cost of validating a v2 configuration with the precompiled
+schema, by number of platforms, alongside the cost of building the schema,
+which used to be paid on every validation.
+
+Usage: PYTHONPATH=. python benchmarks/config_validation.py [iterations]
+"""
+from __future__ import print_function
+import sys
+import timeit
+
+import voluptuous as v
+
+import bossimage.core as bc
+
+
+def make_doc(platforms, profiles=3):
+    return {
+        'defaults': {'instance_type': 't2.micro'},
+        'platforms': [{
+            'name': 'platform-{}'.format(n),
+            'security_groups': ['web', 'ssh'],
+            'block_device_mappings': [{
+                'device_name': '/dev/sdf',
+                'ebs': {'volume_size': 100, 'volume_type': 'gp2'},
+            }],
+            'build': {'source_ami': 'ami-00000000'},
+            'test': {'port': 22},
+        } for n in range(platforms)],
+        'profiles': [{
+            'name': 'profile-{}'.format(n),
+            'extra_vars': {'n': n},
+        } for n in range(profiles)],
+    }
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+    def per_call(func):
+        return timeit.timeit(func, number=iterations) / iterations * 1000
+
+    build = per_call(lambda: v.Schema(bc.V2_SCHEMA.schema))
+    print('{:>10}{:>16}{:>16}'.format('platforms', 'validate (ms)',
+                                      'schema (ms)'))
+    for platforms in (1, 10, 50, 100):
+        doc = make_doc(platforms)
+        validate = per_call(lambda: bc.validate_v2(doc))
+        print('{:>10}{:>16.3f}{:>16.3f}'.format(platforms, validate, build))
+
+
+if __name__ == '__main__':
+    main()
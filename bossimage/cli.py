@@ -18,6 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 import contextlib
+import fnmatch
 import json
 import sys
 
@@ -28,7 +29,15 @@ import bossimage.core as bc
 
 
 @click.group()
-def main(): pass
+@click.option('--lock-timeout', default=bc.LOCK_TIMEOUT, envvar='BI_LOCK_TIMEOUT',
+              help='Seconds to wait for another bi process to release an instance')
+@click.option('--api-stats', is_flag=True,
+              help='Show a summary of the AWS API calls made on exit')
+@click.pass_context
+def main(ctx, lock_timeout, api_stats):
+    bc.LOCK_TIMEOUT = lock_timeout
+    if api_stats:
+        ctx.call_on_close(show_api_stats)
 
 
 @main.command()
@@ -122,41 +131,86 @@ def make(): pass
 
 
 @make.command('build')
-@click.argument('instance')
+@click.argument('instances', nargs=-1)
 @click.option('-v', '--verbosity', count=True,
               help='Verbosity, may be repeated up to 4 times')
-def make_build(instance, verbosity):
+@click.option('-a', '--all', 'make_all', is_flag=True,
+              help='Build all configured instances')
+@click.option('-j', '--jobs', default=4,
+              help='Number of instances to build in parallel')
+@click.option('-f', '--force', is_flag=True,
+              help='Build even if an image of the same role and configuration exists')
+@click.option('-t', '--timings', is_flag=True,
+              help='Show how long each step took')
+def make_build(instances, verbosity, make_all, jobs, force, timings):
     with load_config_v2() as c:
-        validate_instance(instance, c)
-        sys.exit(bc.make_build(instance, c[instance]['build'], verbosity))
+        instances = select_instances(instances, make_all, c)
+        with show_timings(instances, timings):
+            if len(instances) == 1:
+                try:
+                    ret = bc.make_build(instances[0], c[instances[0]]['build'],
+                                        verbosity, force)
+                except (bc.StateError, bc.ConnectionTimeout) as e:
+                    click.echo(e, err=True)
+                    raise click.Abort()
+            else:
+                ret = make_many(bc.make_build, instances, c, 'build', jobs,
+                                verbosity, force)
+        sys.exit(ret)
 
 
 @make.command('image')
-@click.argument('instance')
+@click.argument('instances', nargs=-1)
 @click.option('-w', '--wait/--no-wait', default=True,
               help='Wait for image to be available')
-def make_image(instance, wait):
+@click.option('-a', '--all', 'make_all', is_flag=True,
+              help='Make images of all configured instances')
+@click.option('-j', '--jobs', default=4,
+              help='Number of images to make in parallel')
+@click.option('-t', '--timings', is_flag=True,
+              help='Show how long each step took')
+def make_image(instances, wait, make_all, jobs, timings):
     with load_config_v2() as c:
-        validate_instance(instance, c)
-        try:
-            bc.make_image(instance, c[instance]['image'], wait)
-        except bc.StateError as e:
-            click.echo(e, err=True)
-            raise click.Abort()
+        instances = select_instances(instances, make_all, c)
+        with show_timings(instances, timings):
+            if len(instances) == 1:
+                try:
+                    bc.make_image(instances[0], c[instances[0]]['image'], wait)
+                except bc.StateError as e:
+                    click.echo(e, err=True)
+                    raise click.Abort()
+                ret = 0
+            else:
+                ret = make_many(bc.make_image, instances, c, 'image', jobs,
+                                wait)
+        sys.exit(ret)
 
 
 @make.command('test')
-@click.argument('instance')
+@click.argument('instances', nargs=-1)
 @click.option('-v', '--verbosity', count=True,
               help='Verbosity, may be repeated up to 4 times')
-def make_test(instance, verbosity):
+@click.option('-a', '--all', 'make_all', is_flag=True,
+              help='Test all configured instances')
+@click.option('-j', '--jobs', default=4,
+              help='Number of instances to test in parallel')
+@click.option('-t', '--timings', is_flag=True,
+              help='Show how long each step took')
+def make_test(instances, verbosity, make_all, jobs, timings):
     with load_config_v2() as c:
-        validate_instance(instance, c)
-        try:
-            sys.exit(bc.make_test(instance, c[instance]['test'], verbosity))
-        except bc.StateError as e:
-            click.echo(e, err=True)
-            raise click.Abort()
+        instances = select_instances(instances, make_all, c)
+        with show_timings(instances, timings):
+            if len(instances) == 1:
+                try:
+                    ret = bc.make_test(instances[0], c[instances[0]]['test'],
+                                       verbosity)
+                except (bc.StateError, bc.ConnectionTimeout) as e:
+                    click.echo(e, err=True)
+                    raise click.Abort()
+            else:
+                ret = make_many(bc.make_test, instances, c, 'test', jobs,
+                                verbosity)
+        sys.exit(ret)
 
 
 @main.group()
@@ -181,12 +235,144 @@ def clean_image(instance):
     bc.clean_image(instance)
 
 
+@clean.command('all')
+@click.option('-m', '--match', 'pattern', default='*',
+              help='Only clean instances whose names match this glob pattern')
+@click.option('-w', '--wait', is_flag=True,
+              help='Wait for instances to be terminated')
+@click.option('-j', '--jobs', default=8,
+              help='Number of images and keypairs to delete in parallel')
+def clean_all(pattern, wait, jobs):
+    with load_config_v2() as c:
+        instances = fnmatch.filter(sorted(c.keys()), pattern)
+    failed = bc.clean_all(instances, wait, jobs)
+    if failed:
+        click.echo('Failed to clean {}'.format(', '.join(failed)), err=True)
+        sys.exit(1)
+
+
+@main.command('gc')
+@click.option('-k', '--keep', type=int,
+              help='Keep the newest N images of each role, platform and profile')
+@click.option('-d', '--days', type=int,
+              help='Keep every image created within this many days')
+@click.option('-n', '--dry-run', is_flag=True,
+              help='List the images which would be deleted')
+@click.option('-a', '--all-roles', is_flag=True,
+              help='Consider the images of every role, not just this one')
+@click.option('-j', '--jobs', default=8,
+              help='Number of images to delete in parallel')
+def gc(keep, days, dry_run, all_roles, jobs):
+    if keep is None and days is None:
+        raise click.UsageError('At least one of --keep and --days is required')
+    with load_config_v2() as c:
+        deleted = bc.gc(c, keep, days, dry_run, all_roles, jobs)
+    if not deleted:
+        click.echo('No images to delete')
+
+
+@main.group()
+def cache(): pass
+
+
+@cache.command('clear')
+def cache_clear():
+    bc.clear_caches()
+    click.echo('Cleared {}'.format(bc.cache_dir()))
+
+
+@cache.command('stats')
+def cache_stats():
+    stats = bc.resolution_cache().stats()
+    for key in ('entries', 'hits', 'misses'):
+        click.echo('{:10}{}'.format(key, stats[key]))
+
+
+@main.command('timings')
+@click.argument('instances', nargs=-1)
+@click.option('--json', 'as_json', is_flag=True,
+              help='Output the report as JSON')
+def timings_report(instances, as_json):
+    with load_config_v2() as c:
+        for instance in instances:
+            validate_instance(instance, c)
+        instances = instances or sorted(c.keys())
+    runs = [run for instance in instances for run in bc.load_timings(instance)]
+    report = sorted(bc.aggregate_timings(runs).items())
+    if as_json:
+        click.echo(json.dumps([
+            dict(stats, command=command, step=step)
+            for (command, step), stats in report
+        ], indent=2, separators=(',', ': ')))
+        return
+    click.echo('{:12}{:20}{:>6}{:>10}{:>10}{:>10}'.format(
+        'command', 'step', 'count', 'mean', 'min', 'max'))
+    for (command, step), stats in report:
+        click.echo('{:12}{:20}{count:>6}{mean:>10.1f}{min:>10.1f}{max:>10.1f}'.format(
+            command, step, **stats))
+
+
+@main.group()
+def state(): pass
+
+
+@state.command('import')
+def state_import():
+    with load_config_v2() as c:
+        imported = bc.import_state(c.keys())
+    for instance in imported:
+        click.echo('Imported state of {}'.format(instance))
+
+
 def validate_instance(instance, config):
     if instance not in config:
         click.echo('No such instance {} configured'.format(instance), err=True)
         raise click.Abort()
 
 
+def select_instances(instances, make_all, config):
+    if make_all:
+        return sorted(config.keys())
+    if not instances:
+        click.echo('Pass one or more instances, or --all', err=True)
+        raise click.Abort()
+    for instance in instances:
+        validate_instance(instance, config)
+    return list(instances)
+
+
+def make_many(func, instances, config, phase, jobs, *args):
+    results = bc.make_many(func, instances, config, phase, jobs, *args)
+    click.echo()
+    bc.summarize(results)
+    return 1 if any(r['status'] != 0 for r in results) else 0
+
+
+def show_api_stats():
+    summary = bc.api_metrics().summary()
+    click.echo(err=True)
+    click.echo('{:32}{:>7}{:>8}{:>10}{:>9}{:>9}{:>8}{:>8}'.format(
+        'operation', 'calls', 'errors', 'throttled', 'retries',
+        'mean', 'p50', 'p90'), err=True)
+    for op in summary:
+        click.echo('{operation:32}{calls:>7}{errors:>8}{throttled:>10}{retries:>9}'
+                   '{mean:>9.2f}{p50:>8}{p90:>8}'.format(**op), err=True)
+
+
+@contextlib.contextmanager
+def show_timings(instances, enabled):
+    try:
+        yield
+    finally:
+        if enabled:
+            click.echo()
+            for instance in instances:
+                runs = bc.load_timings(instance)
+                if runs:
+                    for line in bc.format_timings(instance, runs[-1]):
+                        click.echo(line)
+
+
 def find_nested_attr(config, attr):
     """
     Takes a config dictionary and an attribute string as input and tries to
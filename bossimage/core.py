@@ -19,14 +19,24 @@
 # THE SOFTWARE.
 from __future__ import print_function
 import base64
+import collections
+import ConfigParser
 import contextlib
+import copy
+import datetime
+import errno
+import fcntl
 import functools
+import hashlib
+import heapq
 import itertools
 import json
 import os
 import random
 import re
+import shutil
 import socket
+import sqlite3
 import string
 import subprocess
 import sys
@@ -37,15 +47,34 @@ import yaml
 import Queue
 
 import boto3 as boto
+import botocore.config
+import botocore.credentials
+import botocore.exceptions
+import botocore.session
+import concurrent.futures as futures
 import jinja2 as j
+import jinja2.meta as jmeta
+import paramiko
+import requests
+import winrm
+import winrm.exceptions
 import pkg_resources as pr
 import voluptuous as v
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+import bossimage as b
 
 
 class ConnectionTimeout(Exception):
     pass
 
 
+class BootFailure(ConnectionTimeout):
+    pass
+
+
 class ConfigurationError(Exception):
     pass
 
@@ -58,6 +87,10 @@ class ItemNotFound(Exception):
     pass
 
 
+class LockTimeout(StateError):
+    pass
+
+
 class Spinner(t.Thread):
     def __init__(self, waitable, state='to be available'):
         t.Thread.__init__(self)
@@ -65,25 +98,192 @@ class Spinner(t.Thread):
         self.running = False
         self.chars = itertools.cycle(r'-\|/')
         self.q = Queue.Queue()
+        # Capture the output of the calling thread, as the spinner
+        # runs in its own thread and would otherwise go to the terminal.
+        self.out = output_stream() or sys.stdout
+        self.interactive = self.out.isatty()
 
     def __enter__(self):
+        # Set before the thread starts, so that a wait which ends at once
+        # cannot be missed by it.
+        self.running = True
         self.start()
 
     def __exit__(self, _exc_type, _exc_val, _exc_tb):
         self.running = False
         self.q.get()
-        print('\bok')
+        print('\bok', file=self.out)
 
     def run(self):
-        print(self.msg, end='')
-        self.running = True
+        print(self.msg, end='', file=self.out)
         while self.running:
-            print('\b{}'.format(next(self.chars)), end='')
-            sys.stdout.flush()
+            if self.interactive:
+                print('\b{}'.format(next(self.chars)), end='', file=self.out)
+            self.out.flush()
             time.sleep(0.5)
         self.q.put(None)
 
 
+class ThreadOutput(object):
+    """
+    Stands in for sys.stdout while instances are made in parallel. Threads
+    which have set an output stream with `redirect_output` write to it,
+    all others write to the original stream.
+    """
+    local = t.local()
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def target(self):
+        return output_stream() or self.stream
+
+    def write(self, s):
+        self.target().write(s)
+
+    def flush(self):
+        self.target().flush()
+
+    def isatty(self):
+        return self.target().isatty()
+
+    def fileno(self):
+        return self.target().fileno()
+
+
+def output_stream():
+    return getattr(ThreadOutput.local, 'stream', None)
+
+
+@contextlib.contextmanager
+def redirect_output(path):
+    with open(path, 'a') as f:
+        ThreadOutput.local.stream = f
+        try:
+            yield f
+        finally:
+            ThreadOutput.local.stream = None
+
+
+@contextlib.contextmanager
+def thread_output():
+    stdout = sys.stdout
+    sys.stdout = ThreadOutput(stdout)
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+class Timings(object):
+    """
+    Holds the run of a command being timed on each thread, to which the
+    steps timed with `timed` are added.
+    """
+    local = t.local()
+
+
+TIMINGS_KEPT = 50
+
+
+def timed_command(command):
+    """
+    Decorates a function taking an instance as its first argument, so that
+    each call of it is timed as `command` and saved with the timings of the
+    instance's previous runs.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(instance, *args, **kwargs):
+            run = dict(command=command, started=time.time(), steps=[])
+            previous = getattr(Timings.local, 'run', None)
+            Timings.local.run = run
+            try:
+                return func(instance, *args, **kwargs)
+            except Exception as e:
+                run['error'] = type(e).__name__
+                raise
+            finally:
+                Timings.local.run = previous
+                run['total'] = round(time.time() - run['started'], 3)
+                save_timings(instance, run)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def timed(step):
+    """
+    Adds the time taken by the enclosed block to the command being timed
+    on this thread, if there is one.
+    """
+    run = getattr(Timings.local, 'run', None)
+    start = time.time()
+    try:
+        yield
+    finally:
+        if run is not None:
+            run['steps'].append(dict(
+                name=step, duration=round(time.time() - start, 3)))
+
+
+def timings_file(instance):
+    inventory = instance_files(instance)['inventory']
+    return os.path.join(
+        os.path.dirname(inventory), '{}-timings.json'.format(instance))
+
+
+def load_timings(instance):
+    path = timings_file(instance)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_timings(instance, run):
+    path = timings_file(instance)
+    if not os.path.exists(os.path.dirname(path)):
+        return
+    with instance_lock(instance):
+        runs = load_timings(instance) + [run]
+        write_atomic(path, json.dumps(runs[-TIMINGS_KEPT:], indent=2))
+
+
+def format_timings(instance, run):
+    lines = ['{} {} {:.1f}s{}'.format(
+        instance, run['command'], run['total'],
+        ' ({})'.format(run['error']) if 'error' in run else '')]
+    for step in run['steps']:
+        lines.append('  {:<20} {:>8.1f}s'.format(step['name'], step['duration']))
+    if 'api' in run:
+        lines.append('  {} API calls, {} throttled'.format(
+            run['api']['calls'], run['api']['throttled']))
+    return lines
+
+
+def aggregate_timings(runs):
+    """
+    Returns the count, mean, minimum and maximum duration of each command
+    and of each of its steps in `runs`, keyed by (command, step), where the
+    step of the whole command is 'total'.
+    """
+    durations = collections.defaultdict(list)
+    for run in runs:
+        durations[(run['command'], 'total')].append(run['total'])
+        for step in run['steps']:
+            durations[(run['command'], step['name'])].append(step['duration'])
+    return {
+        key: dict(
+            count=len(values),
+            mean=round(sum(values) / len(values), 3),
+            min=min(values),
+            max=max(values),
+        )
+        for key, values in durations.items()
+    }
+
+
 def cached(func):
     cache = {}
 
@@ -96,10 +296,385 @@ def cached(func):
     return wrapper
 
 
-@cached
 def ec2_connect():
-    session = boto.Session()
-    return session.resource('ec2')
+    return session_pool().get(*current_target()).ec2
+
+
+def aws_session():
+    return session_pool().get(*current_target()).session
+
+
+class Target(object):
+    """
+    Holds the region and role that AWS calls made on each thread use.
+    """
+    local = t.local()
+
+
+def current_target():
+    return getattr(Target.local, 'target', (None, None))
+
+
+@contextlib.contextmanager
+def session_target(region=None, role_arn=None):
+    """
+    Makes AWS calls on this thread within the block go to `region`, with
+    the credentials of the role `role_arn` if it is given. Otherwise the
+    region and credentials come from the environment, as usual.
+    """
+    previous = current_target()
+    Target.local.target = (region or None, role_arn or None)
+    try:
+        yield
+    finally:
+        Target.local.target = previous
+
+
+def targeted(func):
+    """
+    Decorates a function taking an instance as its first argument, so that
+    it runs against the region and role in the instance's state. If the
+    state has none yet, they are taken from the configuration passed as the
+    second argument, if any.
+    """
+    @functools.wraps(func)
+    def wrapper(instance, *args, **kwargs):
+        with load_state(instance) as state:
+            target = state.get('target')
+        if target is None and args and isinstance(args[0], collections.Mapping):
+            target = dict(region=args[0].get('region'),
+                          role_arn=args[0].get('role_arn'))
+        with session_target(**(target or {})):
+            return func(instance, *args, **kwargs)
+    return wrapper
+
+
+MAX_POOL_CONNECTIONS = 50
+SESSION_POOL_SIZE = 16
+
+
+class PooledSession(object):
+    def __init__(self, session):
+        self.session = session
+        self.region = session.region_name
+        self.ec2 = session.resource('ec2', config=botocore.config.Config(
+            max_pool_connections=MAX_POOL_CONNECTIONS))
+        self.lock = t.Lock()
+        self._account = None
+
+    @property
+    def account(self):
+        with self.lock:
+            if self._account is None:
+                sts = self.session.client('sts')
+                self._account = sts.get_caller_identity()['Account']
+            return self._account
+
+
+class SessionPool(object):
+    """
+    Holds a session and EC2 resource for each region and role in use,
+    created when they are first needed. Threads needing the same one wait
+    for it to be created once, and the least recently used are dropped
+    when there are more than `size`.
+    """
+    def __init__(self, size=SESSION_POOL_SIZE):
+        self.size = size
+        self.lock = t.Lock()
+        self.entries = collections.OrderedDict()
+        self.creating = collections.defaultdict(t.Lock)
+
+    def get(self, region=None, role_arn=None):
+        key = (region, role_arn)
+        with self.lock:
+            if key in self.entries:
+                entry = self.entries.pop(key)
+                self.entries[key] = entry
+                return entry
+            creating = self.creating[key]
+
+        with creating:
+            with self.lock:
+                if key in self.entries:
+                    return self.entries[key]
+            entry = self.create(region, role_arn)
+            with self.lock:
+                self.entries[key] = entry
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+                self.creating.pop(key, None)
+            return entry
+
+    def create(self, region, role_arn):
+        if role_arn:
+            session = assumed_role_session(
+                self.get(region).session, region, role_arn)
+        else:
+            session = boto.Session(region_name=region)
+        # EC2 API limits apply to each account and region, so each session
+        # has a rate limiter of its own.
+        api_metrics().register(session.events)
+        RateLimiter(api_rates(), api_metrics()).register(session.events)
+        return PooledSession(session)
+
+
+def assumed_role_session(base, region, role_arn):
+    """
+    Returns a session using the credentials of `role_arn`, assumed with
+    those of the session `base`, which are renewed as they expire.
+    """
+    sts = base.client('sts')
+
+    def refresh():
+        creds = sts.assume_role(
+            RoleArn=role_arn, RoleSessionName='bossimage')['Credentials']
+        return dict(
+            access_key=creds['AccessKeyId'],
+            secret_key=creds['SecretAccessKey'],
+            token=creds['SessionToken'],
+            expiry_time=creds['Expiration'].isoformat(),
+        )
+
+    botocore_session = botocore.session.Session()
+    # botocore has no public way to give a session refreshable credentials.
+    botocore_session._credentials = \
+        botocore.credentials.RefreshableCredentials.create_from_metadata(
+            refresh(), refresh, 'assume-role')
+    return boto.Session(botocore_session=botocore_session, region_name=region)
+
+
+@cached
+def session_pool():
+    return SessionPool()
+
+
+THROTTLE_ERRORS = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+
+class ApiMetrics(object):
+    """
+    Counts the AWS API calls made through sessions it is registered with,
+    per operation, along with their errors, retries and throttled attempts,
+    and a histogram of their latencies including any retries.
+    """
+    # Upper bounds in seconds of each bucket of the latency histogram
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self):
+        self.lock = t.Lock()
+        self.operations = {}
+
+    def register(self, events):
+        events.register('before-call', self.before_call)
+        events.register('after-call', self.after_call)
+        # Handlers for needs-retry.ec2, such as RateLimiter's, run before
+        # this one and may stop it from running by deciding the retry;
+        # they then count the throttled attempt with `throttled`.
+        events.register_first('needs-retry', self.needs_retry)
+
+    def operation(self, name):
+        if name not in self.operations:
+            self.operations[name] = dict(
+                calls=0, errors=0, retries=0, throttled=0, latency=0.0,
+                histogram=[0] * len(self.BUCKETS))
+        return self.operations[name]
+
+    def before_call(self, context, **kwargs):
+        context['bossimage_started'] = time.time()
+
+    def after_call(self, parsed, model, context, **kwargs):
+        latency = time.time() - context.get('bossimage_started', time.time())
+        error = parsed.get('Error', {}).get('Code')
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        with self.lock:
+            op = self.operation(model.name)
+            op['calls'] += 1
+            op['errors'] += 1 if error else 0
+            op['retries'] += retries
+            op['latency'] += latency
+            bucket = next(i for i, bound in enumerate(self.BUCKETS)
+                          if latency <= bound)
+            op['histogram'][bucket] += 1
+
+        self.count_run('calls')
+
+    def needs_retry(self, response, operation, **kwargs):
+        if response is None:
+            return
+        error = response[1].get('Error', {}).get('Code')
+        if error in THROTTLE_ERRORS:
+            self.throttled(operation.name)
+
+    def throttled(self, name):
+        with self.lock:
+            self.operation(name)['throttled'] += 1
+        self.count_run('throttled')
+
+    def count_run(self, key):
+        """
+        Counts a call or throttled attempt against the command being timed
+        on this thread, which is the thread making the request.
+        """
+        run = getattr(Timings.local, 'run', None)
+        if run is not None:
+            api = run.setdefault('api', dict(calls=0, throttled=0))
+            api[key] += 1
+
+    def percentile(self, op, fraction):
+        """
+        Returns the upper bound of the histogram bucket holding the
+        `fraction` percentile of the latencies of `op`.
+        """
+        seen = 0
+        for bound, count in zip(self.BUCKETS, op['histogram']):
+            seen += count
+            if seen >= fraction * op['calls']:
+                return bound
+
+    def summary(self):
+        with self.lock:
+            operations = copy.deepcopy(self.operations)
+        return [
+            dict(op, operation=name,
+                 mean=op['latency'] / op['calls'] if op['calls'] else 0,
+                 p50=self.percentile(op, 0.5),
+                 p90=self.percentile(op, 0.9))
+            for name, op in sorted(operations.items())
+        ]
+
+
+@cached
+def api_metrics():
+    return ApiMetrics()
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` acquisitions per second on average, and up to `burst`
+    at once. The rate is halved, down to a tenth of `rate`, each time the
+    calls it limits are throttled, and recovers as they succeed.
+    """
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = t.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 10.0, self.rate / 2.0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20.0)
+
+
+# Calls per second and burst size of each family of EC2 API operations,
+# which may be set with BI_API_RATE_<FAMILY>, e.g. BI_API_RATE_DESCRIBE=10:50
+API_RATES = dict(
+    describe=(20, 100),
+    mutate=(5, 50),
+    create_image=(0.5, 5),
+)
+
+# Retries of throttled calls back off exponentially from RETRY_BASE seconds
+# up to RETRY_CAP, with full jitter, for at most the attempts that botocore
+# itself would make.
+RETRY_ATTEMPTS = 5
+RETRY_BASE = 0.5
+RETRY_CAP = 20
+
+
+def api_family(operation):
+    if operation == 'CreateImage':
+        return 'create_image'
+    if operation.startswith(('Describe', 'Get', 'List')):
+        return 'describe'
+    return 'mutate'
+
+
+def api_rates():
+    rates = {}
+    for family, default in API_RATES.items():
+        value = os.environ.get('BI_API_RATE_{}'.format(family.upper()))
+        if value:
+            rate, _, burst = value.partition(':')
+            try:
+                rate = float(rate)
+                burst = float(burst) if burst else max(1.0, rate)
+            except ValueError:
+                rate = burst = None
+            if rate is None or rate <= 0 or burst < 1:
+                raise ConfigurationError(
+                    'BI_API_RATE_{} must be <rate>[:<burst>] with a rate '
+                    'above 0 and a burst of at least 1, not {}'.format(
+                        family.upper(), value))
+            rates[family] = (rate, burst)
+        else:
+            rates[family] = default
+    return rates
+
+
+class RateLimiter(object):
+    """
+    Limits the rate of EC2 API calls made by every thread, with a token
+    bucket for each family of operations, and retries throttled calls
+    with jittered exponential backoff. Throttled attempts it retries are
+    counted in `metrics`, as the handlers after it do not see them.
+    """
+    def __init__(self, rates, metrics=None):
+        self.buckets = {
+            family: TokenBucket(rate, burst)
+            for family, (rate, burst) in rates.items()
+        }
+        self.metrics = metrics
+
+    def register(self, events):
+        events.register('before-call.ec2', self.before_call)
+        events.register('after-call.ec2', self.after_call)
+        # The first handler to return a delay decides the retry, so this
+        # must come before the one botocore registers on each client.
+        events.register_first('needs-retry.ec2', self.needs_retry)
+
+    def bucket(self, operation):
+        return self.buckets[api_family(operation)]
+
+    def before_call(self, model, **kwargs):
+        self.bucket(model.name).acquire()
+
+    def after_call(self, parsed, model, **kwargs):
+        if parsed.get('Error', {}).get('Code') not in THROTTLE_ERRORS:
+            self.bucket(model.name).succeeded()
+
+    def needs_retry(self, response, operation, attempts, **kwargs):
+        if response is None:
+            return None
+        if response[1].get('Error', {}).get('Code') not in THROTTLE_ERRORS:
+            return None
+        bucket = self.bucket(operation.name)
+        bucket.throttled()
+        if attempts >= RETRY_ATTEMPTS:
+            return None
+        time.sleep(random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** attempts)))
+        bucket.acquire()
+        if self.metrics:
+            self.metrics.throttled(operation.name)
+        return 0
 
 
 def snake_to_camel(s):
@@ -137,21 +712,14 @@ def user_data(config):
     return ud
 
 
-def create_keypair(keyname, keyfile):
+def create_keypair(keyname, *keyfiles):
     kp = ec2_connect().create_key_pair(KeyName=keyname)
     print('Created keypair {}'.format(keyname))
 
-    with open(keyfile, 'w') as f:
-        f.write(kp.key_material)
-    os.chmod(keyfile, 0600)
-
-
-def tag_instance(tags, instance):
-    ec2_connect().create_tags(
-        Resources=[instance.id],
-        Tags=[{'Key': k, 'Value': v} for k, v in tags.items()]
-    )
-    print('Tagged instance with {}'.format(tags))
+    for keyfile in keyfiles:
+        with open(keyfile, 'w') as f:
+            f.write(kp.key_material)
+        os.chmod(keyfile, 0600)
 
 
 def create_instance(config, files, keyname):
@@ -174,6 +742,9 @@ def create_instance(config, files, keyname):
     if config['security_groups']:
         sg_ids = [sg_id_for(name) for name in config['security_groups']]
         instance_params['NetworkInterfaces'][0]['Groups'] = sg_ids
+    if config['tags']:
+        instance_params['TagSpecifications'] = tag_specifications(
+            config['tags'])
 
     (instance,) = ec2_connect().create_instances(**instance_params)
     print('Created instance {}'.format(instance.id))
@@ -181,9 +752,6 @@ def create_instance(config, files, keyname):
     with Spinner('instance', 'to be running'):
         instance.wait_until_running()
 
-    if config['tags']:
-        tag_instance(config['tags'], instance)
-
     instance.reload()
     return instance
 
@@ -204,14 +772,16 @@ def role_version():
     return env_version if env_version else file_version()
 
 
-def decrypt_password(password_file, keyfile):
-    openssl = subprocess.Popen([
-        'openssl', 'rsautl', '-decrypt',
-        '-in', password_file,
-        '-inkey', keyfile,
-    ], stdout=subprocess.PIPE)
-    password, _ = openssl.communicate()
-    return password
+def decrypt_password(encrypted_password, keyfile):
+    """
+    Decrypts the base64 encoded `encrypted_password` of a Windows instance
+    with the private key in `keyfile`.
+    """
+    with open(keyfile, 'rb') as f:
+        key = serialization.load_pem_private_key(
+            f.read(), None, default_backend())
+    return key.decrypt(
+        base64.b64decode(encrypted_password), padding.PKCS1v15())
 
 
 def parse_inventory(fdesc):
@@ -246,22 +816,21 @@ def inventory_entry(ip, keyfile, username, password, port, connection):
 @contextlib.contextmanager
 def load_inventory(instance):
     files = instance_files(instance)
-    if os.path.exists(files['inventory']):
-        with open(files['inventory']) as f:
-            inventory = parse_inventory(f)
-    else:
-        inventory = dict()
-    yield inventory
-    write_inventory(files['inventory'], inventory)
+    with instance_lock(instance):
+        if os.path.exists(files['inventory']):
+            with open(files['inventory']) as f:
+                inventory = parse_inventory(f)
+        else:
+            inventory = dict()
+        yield inventory
+        write_inventory(files['inventory'], inventory)
 
 
 def write_inventory(path, inventory):
     template = '[{}]\n{}'
     inventory_string = '\n'.join(template.format(grp, host)
                                  for grp, host in inventory.items())
-    with open(path, 'w') as f:
-        f.write(inventory_string)
-    os.chmod(path, 0600)
+    write_atomic(path, inventory_string, 0600)
 
 
 def write_playbook(playbook, config):
@@ -273,7 +842,7 @@ def write_playbook(playbook, config):
         )]))
 
 
-def write_files(instance, files, ec2_instance, keyname, config, password):
+def write_files(instance, state, ec2_instance, keyname, config, password):
     if config['associate_public_ip_address']:
         ip_address = ec2_instance.public_ip_address
     else:
@@ -281,14 +850,11 @@ def write_files(instance, files, ec2_instance, keyname, config, password):
 
     files = instance_files(instance)
 
-    with open(files['state'], 'w') as f:
-        f.write(yaml.safe_dump(dict(
-            keyname=keyname,
-            build=dict(
-                id=ec2_instance.id,
-                ip=ip_address
-            )
-        )))
+    state['keyname'] = keyname
+    state['build'] = dict(
+        id=ec2_instance.id,
+        ip=ip_address
+    )
 
     with load_inventory(instance) as inventory:
         inventory['build'] = inventory_entry(
@@ -300,22 +866,108 @@ def write_files(instance, files, ec2_instance, keyname, config, password):
 
 
 def get_windows_password(ec2_instance, keyfile):
-    with Spinner('password'):
+    with timed('password'), Spinner('password'):
         encrypted_password = wait_for_password(ec2_instance)
-    password_file = tempfile.mktemp(dir='.boss')
-    with open(password_file, 'w') as f:
-        f.write(base64.decodestring(encrypted_password))
-    password = decrypt_password(password_file, keyfile)
-    os.unlink(password_file)
-    return password
+    return decrypt_password(encrypted_password, keyfile)
+
+
+def ensure_keypair(instance, state):
+    if 'keyname' in state:
+        return
+    shared = SharedKeypairs.current
+    with timed('keypair'):
+        if shared and instance in shared.groups:
+            state['keyname'], state['shared_with'] = shared.keypair(instance)
+        else:
+            keyname = gen_keyname()
+            create_keypair(keyname, instance_files(instance)['keyfile'])
+            state['keyname'] = keyname
+
+
+def tag_specifications(tags):
+    """
+    Returns the TagSpecifications with which `tags` are applied to an
+    instance and its volumes as it is launched.
+    """
+    if not tags:
+        return []
+    tag_list = [{'Key': k, 'Value': v} for k, v in sorted(tags.items())]
+    return [dict(ResourceType=resource_type, Tags=tag_list)
+            for resource_type in ('instance', 'volume')]
+
+
+# Seconds that a launch waits for identical launches to join its batch.
+LAUNCH_WINDOW = 1
+
+
+class LaunchBatcher(object):
+    """
+    Launches instances for several threads at once. Calls of `launch` with
+    identical parameters in the same region and account within
+    `window` seconds of each other are made with a single RunInstances
+    request, and each caller is given one of the instances launched.
+    """
+    current = None
+
+    def __init__(self, window=LAUNCH_WINDOW):
+        self.window = window
+        self.lock = t.Lock()
+        self.pending = {}
+
+    def launch(self, params):
+        key = (current_target(), json.dumps(params, sort_keys=True))
+        with self.lock:
+            batch = self.pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.pending[key] = dict(
+                    count=0, future=futures.Future())
+            index = batch['count']
+            batch['count'] += 1
+
+        if leader:
+            time.sleep(self.window)
+            with self.lock:
+                del self.pending[key]
+            count = batch['count']
+            try:
+                instances = ec2_connect().create_instances(
+                    **dict(params, MinCount=count, MaxCount=count))
+            except Exception as e:
+                batch['future'].set_exception(e)
+            else:
+                if count > 1:
+                    print('Launched {} identical instances at once'.format(
+                        count))
+                batch['future'].set_result(instances)
+        return batch['future'].result()[index]
+
+
+@contextlib.contextmanager
+def launch_batches(window=LAUNCH_WINDOW):
+    LaunchBatcher.current = LaunchBatcher(window)
+    try:
+        yield
+    finally:
+        LaunchBatcher.current = None
+
+
+def launch_instance(params):
+    if LaunchBatcher.current:
+        return LaunchBatcher.current.launch(params)
+    (ec2_instance,) = ec2_connect().create_instances(
+        MinCount=1, MaxCount=1, **params)
+    return ec2_instance
 
 
 def create_instance_v2(config, image_id, keyname):
+    """
+    Launches an instance of `image_id` with the build or test `config`,
+    without waiting for it to be running.
+    """
     instance_params = dict(
         ImageId=image_id,
         InstanceType=config['instance_type'],
-        MinCount=1,
-        MaxCount=1,
         KeyName=keyname,
         NetworkInterfaces=[dict(
             DeviceIndex=0,
@@ -334,90 +986,356 @@ def create_instance_v2(config, image_id, keyname):
         instance_params['IamInstanceProfile'] = {
             'Name': config['iam_instance_profile']
         }
+    if config['tags']:
+        instance_params['TagSpecifications'] = tag_specifications(
+            config['tags'])
 
-    (ec2_instance,) = ec2_connect().create_instances(**instance_params)
+    with timed('launch'):
+        ec2_instance = launch_instance(instance_params)
     print('Created instance {}'.format(ec2_instance.id))
+    return ec2_instance
 
-    with Spinner('instance', 'to be running'):
-        ec2_instance.wait_until_running()
 
-    if config['tags']:
-        tag_instance(config['tags'], ec2_instance)
+def ensure_running(instance, phase, config):
+    """
+    Waits until the EC2 instance of `phase` in the instance's state is
+    running and records its IP address, unless it has one already. The
+    lock on the state is not held while waiting. Returns the state.
+    """
+    with load_state(instance) as state:
+        if 'ip' in state[phase]:
+            return state
+        ident = state[phase]['id']
 
+    ec2_instance = ec2_connect().Instance(id=ident)
+    with timed('running'), Spinner('instance', 'to be running'):
+        ec2_instance.wait_until_running()
     ec2_instance.reload()
-    return ec2_instance
+    if config['associate_public_ip_address']:
+        ip_address = ec2_instance.public_ip_address
+    else:
+        ip_address = ec2_instance.private_ip_address
+
+    with load_state(instance) as state:
+        state[phase]['ip'] = ip_address
+        return state
 
 
 def load_or_create_instance(config):
     instance = '{}-{}'.format(config['platform'], config['profile'])
     files = instance_files(instance)
 
-    if not os.path.exists(files['state']):
-        keyname = gen_keyname()
+    with load_state(instance) as state:
+        if 'build' not in state:
+            keyname = gen_keyname()
+
+            create_keypair(keyname, files['keyfile'])
+            ec2_instance = create_instance(config, files, keyname)
+
+            if config['connection'] == 'winrm':
+                password = get_windows_password(
+                    ec2_instance, files['keyfile'])
+            else:
+                password = None
+
+            write_files(instance, state, ec2_instance, keyname, config,
+                        password)
+        return dict(state)
+
+
+class Backoff(object):
+    """
+    Iterates over the delays between polls of a condition, starting at
+    `initial` seconds and growing by `factor` up to `maximum`.
+    """
+    def __init__(self, initial=1, factor=1.5, maximum=15):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+
+    def __iter__(self):
+        delay = self.initial
+        while True:
+            yield delay
+            delay = min(delay * self.factor, self.maximum)
+
+
+class Waiter(t.Thread):
+    """
+    Polls any number of conditions from a single scheduling thread. A
+    condition is a function which returns None until it is satisfied.
+    Checks are run on a small pool of threads so that a slow check does
+    not delay the others, and each condition is polled on its own backoff.
+    Checks which block for seconds at a time, such as logging in to an
+    instance, run on a separate, larger pool so that they cannot starve
+    the API polls.
+    """
+    def __init__(self, workers=8, blocking_workers=32):
+        t.Thread.__init__(self)
+        self.daemon = True
+        self.cond = t.Condition()
+        self.heap = []
+        self.seq = itertools.count()
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self.blocking_executor = futures.ThreadPoolExecutor(
+            max_workers=blocking_workers)
+
+    def watch(self, check, backoff=None, end=None, error=None,
+              blocking=False):
+        """
+        Starts polling `check`, returning a future which is resolved with
+        the first value `check` returns other than None. If `check` raises
+        an exception, or `end` passes first, the future fails with that
+        exception or with `error` respectively. Checks which may block for
+        long should be watched with `blocking`.
+        """
+        watched = dict(
+            check=check,
+            delays=iter(backoff or Backoff()),
+            end=end,
+            error=error or ConnectionTimeout('Timeout while waiting'),
+            future=futures.Future(),
+            blocking=blocking,
+        )
+        self.schedule(watched, 0)
+        return watched['future']
 
-        create_keypair(keyname, files['keyfile'])
-        ec2_instance = create_instance(config, files, keyname)
+    def schedule(self, watched, delay):
+        with self.cond:
+            heapq.heappush(
+                self.heap, (time.time() + delay, next(self.seq), watched))
+            self.cond.notify()
 
-        if config['connection'] == 'winrm':
-            encrypted_password = wait_for_password(ec2_instance)
-            password_file = tempfile.mktemp(dir='.boss')
-            with open(password_file, 'w') as f:
-                f.write(base64.decodestring(encrypted_password))
-            password = decrypt_password(password_file, files['keyfile'])
-            os.unlink(password_file)
+    def poll(self, watched):
+        try:
+            result = watched['check']()
+        except Exception as e:
+            watched['future'].set_exception(e)
+            return
+        if result is not None:
+            watched['future'].set_result(result)
+        elif watched['end'] and time.time() > watched['end']:
+            watched['future'].set_exception(watched['error'])
         else:
-            password = None
+            self.schedule(watched, next(watched['delays']))
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    if self.heap:
+                        self.cond.wait(self.heap[0][0] - time.time())
+                    else:
+                        self.cond.wait()
+                _, _, watched = heapq.heappop(self.heap)
+            if watched['blocking']:
+                self.blocking_executor.submit(self.poll, watched)
+            else:
+                self.executor.submit(self.poll, watched)
+
+
+@cached
+def waiter():
+    w = Waiter()
+    w.start()
+    return w
 
-        write_files(instance, files, ec2_instance, keyname, config, password)
 
-    with open(files['state']) as f:
-        return yaml.load(f)
+def wait_until(check, backoff=None, end=None, error=None, blocking=False):
+    future = waiter().watch(check, backoff, end, error, blocking)
+    # Wait with a timeout so that the main thread remains interruptible.
+    while True:
+        try:
+            return future.result(timeout=1)
+        except futures.TimeoutError:
+            pass
 
 
 def wait_for_image(image):
-    while(True):
+    return wait_until(image_available(image), Backoff(5, maximum=30))
+
+
+def image_available(image):
+    def available():
         image.reload()
+        if image.state == 'failed':
+            raise StateError('Image {} failed'.format(image.id))
         if image.state == 'available':
-            break
-        else:
-            time.sleep(15)
+            return image
+    return available
 
 
 def wait_for_password(ec2_instance):
-    while True:
-        ec2_instance.reload()
+    def password():
         pd = ec2_instance.password_data()
-        if pd['PasswordData']:
-            return pd['PasswordData']
-        else:
-            time.sleep(15)
-
+        return pd['PasswordData'] or None
+    # The password is generated within a few minutes of boot, so polling
+    # starts quickly and backs off only as far as a short interval.
+    return wait_until(password, Backoff(2, factor=1.25, maximum=10))
+
+
+def wait_for_connection(addr, port, inventory, group, connection, end,
+                        instance_id=None):
+    with open(inventory) as f:
+        hostvars = inventory_vars(parse_inventory(f)[group])
+
+    # The reason the last attempt failed, to report on timeout
+    reason = ['not attempted']
+    # When the instance was last checked for signs of a failed boot
+    checked = [0]
+    # The checks run on other threads, which do not share this one's target
+    ec2 = ec2_connect()
 
-def wait_for_connection(addr, port, inventory, group, connection, end):
-    env = os.environ.copy()
-    env.update(dict(ANSIBLE_HOST_KEY_CHECKING='False'))
+    def connected():
+        if instance_id and time.time() - checked[0] >= BOOT_CHECK_INTERVAL:
+            checked[0] = time.time()
+            failure = boot_failure(ec2.Instance(instance_id))
+            if failure:
+                raise BootFailure('Instance {} failed to boot: {}'.format(
+                    instance_id, failure))
 
-    while(True):
-        if time.time() > end:
-            message = 'Timeout while connecting to {}:{}'.format(addr, port)
-            raise ConnectionTimeout(message)
         try:
             # First check if port is open.
-            socket.create_connection((addr, port), 1)
-
-            # We didn't raise an exception, so port is open.
-            # Now check if we can actually log in.
-            with open('/dev/null', 'wb') as devnull:
-                ret = subprocess.call([
-                    'ansible', group,
-                    '-i', inventory, '-m', 'raw', '-a', 'exit'
-                ], stderr=devnull, stdout=devnull, env=env)
-                if ret == 0:
-                    break
-                else:
-                    raise
-        except:
-            time.sleep(15)
+            socket.create_connection((addr, port), 1).close()
+        except socket.error as e:
+            reason[0] = 'port closed: {}'.format(e)
+            return None
+
+        # We didn't raise an exception, so port is open.
+        # Now check if we can actually log in.
+        if connection == 'ssh':
+            reason[0] = ssh_ready(
+                addr, port, hostvars['ansible_user'],
+                hostvars['ansible_ssh_private_key_file'])
+        else:
+            reason[0] = winrm_ready(
+                addr, port, hostvars['ansible_user'],
+                hostvars['ansible_password'])
+        return True if reason[0] is None else None
+
+    backoff = Backoff(0.25, maximum=1)
+    try:
+        with timed('connection'):
+            wait_until(connected, backoff, end, ConnectionTimeout(),
+                       blocking=True)
+    except BootFailure:
+        raise
+    except ConnectionTimeout:
+        raise ConnectionTimeout('Timeout while connecting to {}:{} ({})'.format(
+            addr, port, reason[0]))
+
+
+BOOT_CHECK_INTERVAL = 10
+
+# Console output which means an instance will never become reachable.
+# Services such as sshd are not matched, as systemd may restart them.
+BOOT_FAILURES = [
+    r'Kernel panic',
+    r'VFS: Unable to mount root fs',
+    r'Give root password for maintenance',
+    r'You are in emergency mode',
+    r'No bootable device',
+]
+
+
+def boot_failure(ec2_instance):
+    """
+    Returns the reason `ec2_instance` has failed to boot, or None if there
+    is no sign that it has. The instance has failed if it has stopped or
+    terminated, if either of its status checks is impaired, or if its
+    console output matches any of BOOT_FAILURES.
+    """
+    try:
+        ec2_instance.reload()
+        state = ec2_instance.state['Name']
+        if state in ('shutting-down', 'terminated', 'stopping', 'stopped'):
+            return 'instance is {} ({})'.format(
+                state, (ec2_instance.state_reason or {}).get('Message'))
+
+        statuses = ec2_instance.meta.client.describe_instance_status(
+            InstanceIds=[ec2_instance.id])['InstanceStatuses']
+        for status in statuses:
+            for check in ('SystemStatus', 'InstanceStatus'):
+                if status[check]['Status'] == 'impaired':
+                    return '{} check is impaired ({})'.format(
+                        check, ', '.join(
+                            '{Name}: {Status}'.format(**d)
+                            for d in status[check].get('Details', [])))
+
+        output = ec2_instance.console_output().get('Output') or ''
+    except botocore.exceptions.ClientError:
+        # The instance may not be visible to the API yet
+        return None
+
+    for line in output.splitlines():
+        for pattern in BOOT_FAILURES:
+            if re.search(pattern, line):
+                return 'console output shows "{}"'.format(line.strip())
+
+
+def ssh_ready(addr, port, username, keyfile, timeout=5):
+    """
+    Opens an SSH session to `addr` and runs a no-op command in it. Returns
+    None if this succeeds, otherwise the reason it did not.
+    """
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        client.connect(
+            addr, port=port, username=username, key_filename=keyfile,
+            timeout=timeout, banner_timeout=timeout,
+            allow_agent=False, look_for_keys=False,
+        )
+        _, stdout, _ = client.exec_command('exit 0', timeout=timeout)
+        status = stdout.channel.recv_exit_status()
+        if status != 0:
+            return 'no-op exited with status {}'.format(status)
+    except paramiko.AuthenticationException as e:
+        return 'authentication failed: {}'.format(e)
+    except (paramiko.SSHException, EOFError) as e:
+        return 'ssh error: {}'.format(e or type(e).__name__)
+    except socket.error as e:
+        return 'connection failed: {}'.format(e)
+    finally:
+        client.close()
+
+
+def winrm_ready(addr, port, username, password, timeout=5):
+    """
+    Runs a no-op command on `addr` over WinRM. Returns None if this
+    succeeds, otherwise the reason it did not. HTTPS is used on port 5986,
+    as Ansible does, with the instance's self-signed certificate accepted.
+    """
+    if port == 5986:
+        endpoint = 'https://{}:{}/wsman'.format(addr, port)
+        transport = 'ssl'
+    else:
+        endpoint = 'http://{}:{}/wsman'.format(addr, port)
+        transport = 'plaintext'
+    session = winrm.Session(
+        endpoint, (username, password), transport=transport,
+        server_cert_validation='ignore',
+        operation_timeout_sec=timeout, read_timeout_sec=timeout + 1,
+    )
+    try:
+        result = session.run_cmd('exit', ['0'])
+        if result.status_code != 0:
+            return 'no-op exited with status {}'.format(result.status_code)
+    except winrm.exceptions.AuthenticationError as e:
+        return 'authentication failed: {}'.format(e)
+    except (winrm.exceptions.WinRMError,
+            winrm.exceptions.WinRMTransportError,
+            winrm.exceptions.WinRMOperationTimeoutError) as e:
+        return 'winrm error: {}'.format(e or type(e).__name__)
+    except requests.RequestException as e:
+        return 'connection failed: {}'.format(e)
+
+
+def inventory_vars(entry):
+    """
+    Returns the host variables in `entry`, a line of an inventory.
+    """
+    return dict(kv.split('=', 1) for kv in entry.split()[1:])
 
 
 def run(instance, config, verbosity):
@@ -433,7 +1351,8 @@ def run(instance, config, verbosity):
     end = time.time() + config['connection_timeout']
     with Spinner('connection to {}:{}'.format(ip, port)):
         wait_for_connection(
-            ip, port, files['inventory'], 'build', config['connection'], end)
+            ip, port, files['inventory'], 'build', config['connection'], end,
+            instance_info['build']['id'])
 
     env = os.environ.copy()
 
@@ -466,7 +1385,9 @@ def run(instance, config, verbosity):
     return ansible_playbook.wait()
 
 
-def make_build(instance, config, verbosity):
+@timed_command('build')
+@targeted
+def make_build(instance, config, verbosity, force=False):
     if not os.path.exists('.boss'):
         os.mkdir('.boss')
 
@@ -474,25 +1395,61 @@ def make_build(instance, config, verbosity):
     keyfile = files['keyfile']
 
     with load_state(instance) as state:
-        if 'keyname' not in state:
-            keyname = gen_keyname()
-            create_keypair(keyname, keyfile)
-            state['keyname'] = keyname
+        if 'target' not in state:
+            region, role_arn = current_target()
+            state['target'] = dict(region=region, role_arn=role_arn)
+
+    with load_state(instance) as state:
+        if 'build' not in state:
+            with timed('resolve'):
+                source_ami = ami_id_for(config['source_ami'])
+                fingerprint = (config.get('fingerprint') or
+                               build_fingerprint(config, source_ami))
+
+            if not force:
+                if 'image' not in state:
+                    image = find_image(ec2_connect(), fingerprint)
+                    if image:
+                        state['image'] = {
+                            'id': image.id,
+                            'fingerprint': fingerprint,
+                            'reused': True,
+                        }
+                if state.get('image', {}).get('fingerprint') == fingerprint:
+                    print('Image {} was built from the same role and '
+                          'configuration, skipping build'.format(
+                              state['image']['id']))
+                    return 0
+
+    # Layers are built outside of the lock on the instance's state,
+    # as building them may take much longer than the lock timeout.
+    if 'build' not in state and (config.get('layers') or
+                                 config.get('fanout')):
+        with timed('layers'):
+            source_ami = build_layers(config, source_ami, verbosity)
 
     with load_state(instance) as state:
         if 'build' not in state:
+            # The keypair is only made once the build is known to be
+            # needed, so that a skipped build leaves none behind.
+            ensure_keypair(instance, state)
             ec2_instance = create_instance_v2(
-                config, ami_id_for(config['source_ami']), state['keyname']
+                config, source_ami, state['keyname']
             )
-            if config['associate_public_ip_address']:
-                ip_address = ec2_instance.public_ip_address
-            else:
-                ip_address = ec2_instance.private_ip_address
+            # The instance is recorded as soon as it is launched, and is
+            # given its IP address once it is running.
             state['build'] = {
                 'id': ec2_instance.id,
-                'ip': ip_address,
+                'fingerprint': fingerprint,
             }
-
+            # A forced build must not be replaced by an existing image
+            # when it is made into one.
+            if force:
+                state['build']['force'] = True
+                if state.get('image', {}).get('reused'):
+                    del(state['image'])
+
+    state = ensure_running(instance, 'build', config)
     ensure_inventory(
         instance, 'build', config, keyfile,
         state['build']['id'], state['build']['ip'])
@@ -501,34 +1458,172 @@ def make_build(instance, config, verbosity):
             state['build']['ip'], config['port'])):
         wait_for_connection(
             state['build']['ip'], config['port'], files['inventory'], 'build',
-            config['connection'], time.time() + config['connection_timeout']
+            config['connection'], time.time() + config['connection_timeout'],
+            state['build']['id']
         )
 
-    if not os.path.exists(files['playbook']):
-        write_playbook(files['playbook'], config)
+    # The playbook is given in the configuration of layers, otherwise
+    # one is generated to run the role.
+    playbook = config.get('playbook')
+    if not playbook:
+        playbook = files['playbook']
+        if not os.path.exists(playbook):
+            write_playbook(playbook, config)
+
+    write_ansible_config(files['ansible_cfg'], facts_dir(instance), config)
+    return run_ansible(verbosity, files['inventory'], playbook,
+                       config['extra_vars'], 'requirements.yml',
+                       files['ansible_cfg'])
+
+
+def build_layers(config, source_ami, verbosity):
+    """
+    Builds each of the layers in the build configuration in turn, each on
+    top of the image of the one before it, starting from `source_ami`.
+    The image of a layer is reused if one exists with the same inputs.
+    Returns the ID of the image of the last layer.
+    """
+    layers = list(config.get('layers', []))
+    if config.get('fanout'):
+        layers.append(base_layer(config))
+
+    parent = source_ami
+    for layer in layers:
+        fingerprint = layer_fingerprint(config, layer, parent)
+        image = find_image(ec2_connect(), fingerprint)
+        if image:
+            print('Using image {} for layer {}'.format(image.id, layer['name']))
+            parent = image.id
+        else:
+            parent = make_layer(config, layer, parent, fingerprint, verbosity)
+    return parent
+
+
+def base_layer(config):
+    """
+    Returns a layer which runs the role without the extra_vars of any
+    profile, shared by all profiles of the platform in `config`. Each
+    profile's build then only has to apply what differs from it.
+    """
+    playbook = instance_files('{}-base'.format(config['platform']))['playbook']
+    if not os.path.exists(playbook):
+        write_playbook(playbook, config)
+    return {
+        'name': 'base',
+        'playbook': playbook,
+        'extra_vars': {},
+        'inputs': ['.'],
+    }
 
-    return run_ansible(verbosity, files['inventory'], files['playbook'],
-                       config['extra_vars'], 'requirements.yml')
 
+def make_layer(config, layer, parent, fingerprint, verbosity):
+    instance = '{}-layer-{}'.format(config['platform'], layer['name'])
+
+    # Hold the lock on the layer while it is built, so that other
+    # instances waiting on the same layer use its image when it is done.
+    with instance_lock(instance, timeout=float('inf')):
+        image = find_image(ec2_connect(), fingerprint)
+        if image:
+            print('Using image {} for layer {}'.format(
+                image.id, layer['name']))
+            return image.id
+
+        print('Building layer {} from {}'.format(layer['name'], parent))
+        layer_config = dict(
+            config,
+            source_ami=parent,
+            extra_vars=layer['extra_vars'],
+            playbook=layer['playbook'],
+            layers=[],
+            fanout=False,
+            fingerprint=fingerprint,
+        )
+        ret = make_build(instance, layer_config, verbosity, force=True)
+        if ret != 0:
+            raise StateError('Build of layer {} failed, see instance {}'.format(
+                layer['name'], instance))
+
+        image_config = dict(
+            ami_name='%(role)s.%(platform)s.{}.{}'.format(
+                layer['name'], fingerprint[:16]),
+            platform=config['platform'],
+            profile='layer-{}'.format(layer['name']),
+        )
+        make_image(instance, image_config, True)
+        with load_state(instance) as state:
+            image_id = state['image']['id']
 
+        # The layer is kept only as a tagged image, so its build
+        # instance and state are no longer needed.
+        clean_build(instance)
+        with load_state(instance) as state:
+            state.clear()
+        delete_files(instance_files(instance))
+        shutil.rmtree(facts_dir(instance), ignore_errors=True)
+        return image_id
+
+
+# Build settings which the image of a layer depends on. The others, such
+# as extra_vars, differ between profiles which share their layers.
+LAYER_SETTINGS = (
+    'platform', 'instance_type', 'block_device_mappings', 'become',
+    'iam_instance_profile',
+)
+
+
+def layer_fingerprint(config, layer, parent):
+    """
+    Returns a hash of the inputs to a layer: the image it is built on, the
+    settings in LAYER_SETTINGS and the user data of the build
+    configuration `config`, the layer's own configuration, and the
+    contents of its playbook and any other paths listed in its `inputs`.
+    """
+    h = hashlib.sha1()
+    h.update(parent)
+    h.update(json.dumps({k: config.get(k) for k in LAYER_SETTINGS},
+                        sort_keys=True))
+    h.update(user_data(config) or '')
+    h.update(json.dumps(layer, sort_keys=True))
+    for path in [layer['playbook']] + layer['inputs']:
+        for filename in walk_files(path, exclude=('.boss', '.git', 'tests')):
+            with open(filename, 'rb') as f:
+                h.update('{}\0{}\0'.format(
+                    filename, hashlib.sha1(f.read()).hexdigest()))
+    return h.hexdigest()
+
+
+def walk_files(path, exclude=()):
+    """
+    Returns the files under `path` in a stable order, skipping any
+    directories named in `exclude`. If `path` is a file it is returned.
+    """
+    if os.path.isfile(path):
+        return [path]
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if d not in exclude)
+        paths.extend(os.path.join(dirpath, f) for f in sorted(filenames)
+                     if os.path.isfile(os.path.join(dirpath, f)))
+    return paths
+
+
+@timed_command('test')
+@targeted
 def make_test(instance, config, verbosity):
     with load_state(instance) as state:
         if 'test' not in state and 'image' not in state:
             raise StateError('Cannot run `make test` before `make image`')
 
         if 'test' not in state:
+            # The build may have been skipped in favour of an existing
+            # image, without making a keypair.
+            ensure_keypair(instance, state)
             ec2_instance = create_instance_v2(
                 config, state['image']['id'], state['keyname']
             )
-            if config['associate_public_ip_address']:
-                ip_address = ec2_instance.public_ip_address
-            else:
-                ip_address = ec2_instance.private_ip_address
-            state['test'] = {
-                'id': ec2_instance.id,
-                'ip': ip_address,
-            }
+            state['test'] = {'id': ec2_instance.id}
 
+    state = ensure_running(instance, 'test', config)
     files = instance_files(instance)
 
     ensure_inventory(
@@ -539,47 +1634,60 @@ def make_test(instance, config, verbosity):
             state['test']['ip'], config['port'])):
         wait_for_connection(
             state['test']['ip'], config['port'], files['inventory'], 'test',
-            config['connection'], time.time() + config['connection_timeout']
+            config['connection'], time.time() + config['connection_timeout'],
+            state['test']['id']
         )
 
+    write_ansible_config(files['ansible_cfg'], facts_dir(instance), config)
     return run_ansible(verbosity, files['inventory'], config['playbook'], {},
-                       'tests/requirements.yml')
+                       'tests/requirements.yml', files['ansible_cfg'])
 
 
 def ensure_inventory(instance, phase, config, keyfile, ident, ip):
     with load_inventory(instance) as inventory:
-        if phase not in inventory:
-            ec2_instance = ec2_connect().Instance(id=ident)
-            if config['connection'] == 'winrm':
-                password = get_windows_password(ec2_instance, keyfile)
-            else:
-                password = None
+        if phase in inventory:
+            return
 
-            inventory[phase] = inventory_entry(
-                ip, keyfile, config['username'],
-                password, config['port'], config['connection']
-            )
+    # The password may take minutes to be available, so it is waited
+    # for without holding the lock on the instance.
+    ec2_instance = ec2_connect().Instance(id=ident)
+    if config['connection'] == 'winrm':
+        password = get_windows_password(ec2_instance, keyfile)
+    else:
+        password = None
+
+    with load_inventory(instance) as inventory:
+        inventory[phase] = inventory_entry(
+            ip, keyfile, config['username'],
+            password, config['port'], config['connection']
+        )
 
+        # Ansible caches facts in a file named after the inventory
+        # host, and an earlier instance may have had the same IP.
+        facts = os.path.join(facts_dir(instance), ip)
+        if os.path.exists(facts):
+            os.unlink(facts)
 
-def run_ansible(verbosity, inventory, playbook, extra_vars, requirements):
+
+def run_ansible(verbosity, inventory, playbook, extra_vars, requirements,
+                ansible_cfg=None):
     roles_path = '.boss/roles'
 
+    stdout = output_stream()
+    stderr = subprocess.STDOUT if stdout else None
+
     env = os.environ.copy()
-    env.update(dict(
-        ANSIBLE_ROLES_PATH='{}:..'.format(roles_path),
-        ANSIBLE_HOST_KEY_CHECKING='False',
-    ))
+    env.update(dict(ANSIBLE_HOST_KEY_CHECKING='False'))
+    if ansible_cfg:
+        env.update(dict(ANSIBLE_CONFIG=ansible_cfg))
 
     if os.path.exists(requirements):
-        ansible_galaxy_args = [
-            'ansible-galaxy', 'install',
-            '-r', 'requirements.yml',
-            '-p', roles_path,
-        ]
-        if verbosity:
-            ansible_galaxy_args.append('-' + 'v' * verbosity)
-        ansible_galaxy = subprocess.Popen(ansible_galaxy_args, env=env)
-        ansible_galaxy.wait()
+        with timed('galaxy'):
+            roles_path, ret = galaxy_roles(requirements, verbosity, env)
+        if ret != 0:
+            return ret
+
+    env.update(dict(ANSIBLE_ROLES_PATH='{}:..'.format(roles_path)))
 
     ansible_playbook_args = ['ansible-playbook', '-i', inventory]
     if verbosity:
@@ -587,44 +1695,452 @@ def run_ansible(verbosity, inventory, playbook, extra_vars, requirements):
     if extra_vars:
         ansible_playbook_args += ['--extra-vars', json.dumps(extra_vars)]
     ansible_playbook_args.append(playbook)
-    ansible_playbook = subprocess.Popen(ansible_playbook_args, env=env)
-    return ansible_playbook.wait()
+    with timed('playbook'):
+        ansible_playbook = subprocess.Popen(
+            ansible_playbook_args, env=env, stdout=stdout, stderr=stderr)
+        return ansible_playbook.wait()
+
+
+def ansible_config(facts, project, overrides):
+    """
+    Returns the settings for ansible.cfg as a map of sections to options,
+    with the options in `project` replacing the defaults, and those in
+    `overrides` replacing both.
+    """
+    settings = {
+        'defaults': {
+            'forks': 10,
+            'gathering': 'smart',
+            'fact_caching': 'jsonfile',
+            'fact_caching_connection': facts,
+            'fact_caching_timeout': 86400,
+            'host_key_checking': False,
+            'retry_files_enabled': False,
+        },
+        'ssh_connection': {
+            'ssh_args': '-o ControlMaster=auto -o ControlPersist=60s',
+            'pipelining': True,
+        },
+    }
+    for layer in (project, overrides):
+        for section, options in layer.items():
+            settings.setdefault(section, {}).update(options)
+    return settings
+
+
+def project_ansible_config():
+    """
+    Returns the settings of the ansible.cfg that Ansible would otherwise
+    use for the project, the one named by ANSIBLE_CONFIG or the one in the
+    current directory, as a map of sections to options.
+    """
+    path = os.environ.get('ANSIBLE_CONFIG') or 'ansible.cfg'
+    parser = ConfigParser.RawConfigParser()
+    try:
+        parser.read(path)
+    except ConfigParser.Error as e:
+        raise ConfigurationError('Error loading {}: {}'.format(path, e))
+    return {section: dict(parser.items(section))
+            for section in parser.sections()}
+
+
+def write_ansible_config(path, facts, config):
+    parser = ConfigParser.RawConfigParser()
+    settings = ansible_config(
+        os.path.abspath(facts), project_ansible_config(),
+        config.get('ansible_config', {}))
+    for section in sorted(settings):
+        parser.add_section(section)
+        for option, value in sorted(settings[section].items()):
+            parser.set(section, option, value)
+    with open(path, 'w') as f:
+        parser.write(f)
+
+
+def galaxy_roles(requirements, verbosity, env):
+    """
+    Returns the path to the roles listed in `requirements`, along with the
+    exit status of ansible-galaxy. Roles are installed into a cache shared
+    by all instances and roles, keyed by the hash of the requirements
+    file, and ansible-galaxy is only run when they are not already there.
+    """
+    with open(requirements) as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    roles_path = os.path.join(cache_dir(), 'roles', digest)
+    if os.path.exists(roles_path):
+        print('Using roles from {} cached in {}'.format(
+            requirements, roles_path))
+        return roles_path, 0
+
+    parent = os.path.dirname(roles_path)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    ret = install_roles(requirements, tmp, verbosity, env)
+    if ret != 0:
+        shutil.rmtree(tmp)
+        return roles_path, ret
+    try:
+        os.rename(tmp, roles_path)
+    except OSError:
+        # Another process has installed the same roles in the meantime.
+        shutil.rmtree(tmp)
+    return roles_path, 0
+
+
+def install_roles(requirements, roles_path, verbosity, env):
+    stdout = output_stream()
+    stderr = subprocess.STDOUT if stdout else None
+
+    ansible_galaxy_args = [
+        'ansible-galaxy', 'install',
+        '-r', requirements,
+        '-p', roles_path,
+    ]
+    if verbosity:
+        ansible_galaxy_args.append('-' + 'v' * verbosity)
+    ansible_galaxy = subprocess.Popen(
+        ansible_galaxy_args, env=env, stdout=stdout, stderr=stderr)
+    return ansible_galaxy.wait()
 
 
+@timed_command('image')
+@targeted
 def make_image(instance, config, wait):
     with load_state(instance) as state:
         if 'image' in state:
-            return
+            image = None
+        else:
+            image = create_image(state, config)
 
-        if 'build' not in state:
-            raise StateError('Cannot run `make image` before `make build`')
-        ec2 = ec2_connect()
-        ec2_instance = ec2.Instance(id=state['build']['id'])
-        ec2_instance.load()
-
-        config.update({
-            'role': role_name(),
-            'version': role_version(),
-            'arch': ec2_instance.architecture,
-            'hv': ec2_instance.hypervisor,
-            'vtype': ec2_instance.virtualization_type,
-        })
-
-        image_name = config['ami_name'] % config
+    if image and wait:
+        with timed('image-available'), Spinner('image'):
+            wait_for_image(image)
+
+    copies = state['image'].get('copies', {})
+    regions = [r for r in config.get('copy_to', []) if r not in copies]
+    if not regions:
+        return
+    if not wait:
+        print('Image will be copied to {} when `make image` is run '
+              'again with --wait'.format(', '.join(regions)))
+        return
+    if not image:
+        image = ec2_connect().Image(state['image']['id'])
+        with timed('image-available'), Spinner('image'):
+            wait_for_image(image)
+    copy_image(instance, image, regions)
+
+
+def create_image(state, config):
+    """
+    Creates an image of the build instance in `state`, unless an image
+    with the same fingerprint exists already and the build was not forced,
+    and records it in `state`. Returns the new image, or None if one was
+    found.
+    """
+    if 'build' not in state:
+        raise StateError('Cannot run `make image` before `make build`')
+    ec2 = ec2_connect()
+
+    fingerprint = state['build'].get('fingerprint')
+    image = None
+    if fingerprint and not state['build'].get('force'):
+        image = find_image(ec2, fingerprint)
+    if image:
+        print('Using image {} built from the same role and '
+              'configuration'.format(image.id))
+        state['image'] = {
+            'id': image.id,
+            'fingerprint': fingerprint,
+            'reused': True,
+        }
+        return None
+
+    ec2_instance = ec2.Instance(id=state['build']['id'])
+    ec2_instance.load()
+
+    config.update({
+        'role': role_name(),
+        'version': role_version(),
+        'arch': ec2_instance.architecture,
+        'hv': ec2_instance.hypervisor,
+        'vtype': ec2_instance.virtualization_type,
+    })
+
+    image_name = config['ami_name'] % config
+    with timed('create-image'):
         image = ec2_instance.create_image(Name=image_name)
-        print('Created image {} with name {}'.format(image.id, image_name))
+        image.create_tags(Tags=image_tags(config, fingerprint))
+    print('Created image {} with name {}'.format(image.id, image_name))
+    state['image'] = {'id': image.id, 'fingerprint': fingerprint}
+    return image
+
+
+def copy_image(instance, image, regions):
+    """
+    Copies the available `image` to each of `regions` at once, recording
+    the ID of each copy in the instance's state as soon as it is started,
+    then waits for all copies to be available. An image of the same
+    fingerprint already in a region is used instead of copying again, and
+    only the regions copied to are listed in the state as `copied`, since
+    the copies found there belong to other builds.
+    """
+    role_arn = current_target()[1]
+    source_region = ec2_connect().meta.client.meta.region_name
+    image.load()
+    tags = [tag for tag in image.tags or []
+            if not tag['Key'].startswith('aws:')]
+    fingerprint = dict((tag['Key'], tag['Value']) for tag in tags).get(
+        'bossimage:fingerprint')
+
+    copies = {}
+    with timed('copy-image'):
+        for region in regions:
+            with session_target(region, role_arn):
+                ec2 = ec2_connect()
+                copy = find_image(ec2, fingerprint) if fingerprint else None
+                if copy:
+                    print('Using image {} in {}'.format(copy.id, region))
+                    found = True
+                else:
+                    copy_id = ec2.meta.client.copy_image(
+                        SourceRegion=source_region, SourceImageId=image.id,
+                        Name=image.name, Description=image.description or '',
+                    )['ImageId']
+                    copy = ec2.Image(copy_id)
+                    print('Copying image {} to {} as {}'.format(
+                        image.id, region, copy_id))
+                    found = False
+            copies[region] = copy
+            # The copy is recorded before it is tagged, so that it can
+            # still be cleaned if tagging fails.
+            with load_state(instance) as state:
+                state['image'].setdefault('copies', {})[region] = copy.id
+                if not found:
+                    state['image'].setdefault('copied', []).append(region)
+            if tags and not found:
+                with session_target(region, role_arn):
+                    tag_new_image(copy, tags)
+
+    with timed('copies-available'), Spinner('copies'):
+        waiting = {
+            waiter().watch(image_available(copy), Backoff(15, maximum=60)):
+            region for region, copy in copies.items()
+        }
+        # Wait with a timeout so that the main thread remains interruptible.
+        while futures.wait(waiting, timeout=1).not_done:
+            pass
+
+    failed = sorted(region for future, region in waiting.items()
+                    if future.exception())
+    if failed:
+        # Forget the failed copies, so they are made again on the next run
+        with load_state(instance) as state:
+            for region in failed:
+                del(state['image']['copies'][region])
+                if region in state['image'].get('copied', []):
+                    state['image']['copied'].remove(region)
+        raise StateError('Copying image {} to {} failed'.format(
+            image.id, ', '.join(failed)))
 
-        state['image'] = {'id': image.id}
 
-    if wait:
-        with Spinner('image'):
-            wait_for_image(image)
+TAG_ATTEMPTS = 5
+
+
+def tag_new_image(image, tags):
+    """
+    Tags `image`, retrying while it is not yet visible to the API, as is
+    common right after it is created.
+    """
+    for attempt, delay in zip(range(TAG_ATTEMPTS), Backoff(0.5, maximum=5)):
+        try:
+            image.create_tags(Tags=tags)
+            return
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code != 'InvalidAMIID.NotFound' or attempt == TAG_ATTEMPTS - 1:
+                raise
+            time.sleep(delay)
+
+
+def build_fingerprint(config, source_ami):
+    """
+    Returns a hash of everything that goes into building an image: the
+    files of the role, its version, the source AMI and the build
+    configuration, including extra_vars and user data.
+    """
+    h = hashlib.sha1()
+    for path in walk_files('.', exclude=('.boss', '.git', 'tests')):
+        with open(path, 'rb') as f:
+            h.update('{}\0{}\0'.format(
+                path, hashlib.sha1(f.read()).hexdigest()))
+    h.update(role_version())
+    h.update(source_ami)
+    h.update(json.dumps(config, sort_keys=True))
+    h.update(user_data(config) or '')
+    return h.hexdigest()
+
+
+def find_image(ec2, fingerprint):
+    """
+    Returns the newest available image owned by this account which is
+    tagged with `fingerprint`, or None.
+    """
+    images = ec2.images.filter(Owners=['self'], Filters=[{
+        'Name': 'tag:bossimage:fingerprint', 'Values': [fingerprint],
+    }])
+    available = [i for i in images if i.state == 'available']
+    if available:
+        return sorted(available, key=lambda i: i.creation_date)[-1]
+
+
+def image_tags(config, fingerprint):
+    tags = {
+        'bossimage:role': config['role'],
+        'bossimage:version': config['version'],
+        'bossimage:platform': config['platform'],
+        'bossimage:profile': config['profile'],
+    }
+    if fingerprint:
+        tags['bossimage:fingerprint'] = fingerprint
+    return [{'Key': k, 'Value': v} for k, v in sorted(tags.items())]
+
+
+def log_file(instance, phase):
+    return '.boss/{}-{}.log'.format(instance, phase)
+
+
+def make_one(func, instance, config, phase, *args):
+    start = time.time()
+    logfile = log_file(instance, phase)
+    with redirect_output(logfile):
+        try:
+            ret = func(instance, config[instance][phase], *args)
+            status, error = ret or 0, None
+        except Exception as e:
+            print('Error: {}'.format(e))
+            status, error = 1, str(e)
+    return dict(
+        instance=instance,
+        status=status,
+        error=error,
+        duration=time.time() - start,
+        log=logfile,
+    )
+
+
+def make_many(func, instances, config, phase, jobs, *args):
+    """
+    Calls `func`, which is one of `make_build`, `make_image` or `make_test`,
+    for each of `instances` using a pool of `jobs` threads. The output of
+    each instance is written to its own log file under .boss, and a list of
+    results is returned in the order of `instances`.
+    """
+    if not os.path.exists('.boss'):
+        os.mkdir('.boss')
+
+    if phase in ('build', 'test'):
+        preresolve(config, instances)
+    sharing = instances if phase == 'build' else []
+
+    results = {}
+    with thread_output(), launch_batches(), \
+            share_keypairs(config, sharing):
+        with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            pending = {
+                executor.submit(make_one, func, instance, config, phase, *args):
+                instance for instance in instances
+            }
+            for future in futures.as_completed(pending):
+                result = future.result()
+                results[result['instance']] = result
+                print('Finished {} {} ({})'.format(
+                    phase, result['instance'], result_status(result)))
+    return [results[instance] for instance in instances]
+
+
+class SharedKeypairs(object):
+    """
+    Gives the instances in each of `groups` one keypair between them, so
+    that those with identical launch parameters can be launched together.
+    The keypair of a group is created when the first of its instances is
+    launched, so none is made for a group whose builds are all skipped.
+    """
+    current = None
+
+    def __init__(self, groups):
+        self.groups = {instance: group for group in groups
+                       for instance in group}
+        self.lock = t.Lock()
+        self.created = {}
+
+    def keypair(self, instance):
+        """
+        Returns the name of the keypair of `instance`'s group and the
+        other instances in the group, writing the private key to the
+        instance's keyfile.
+        """
+        group = self.groups[instance]
+        keyfile = instance_files(instance)['keyfile']
+        with self.lock:
+            if group not in self.created:
+                keyname = gen_keyname()
+                create_keypair(keyname, keyfile)
+                self.created[group] = (keyname, keyfile)
+                return keyname, [i for i in group if i != instance]
+        keyname, created_keyfile = self.created[group]
+        shutil.copyfile(created_keyfile, keyfile)
+        os.chmod(keyfile, 0600)
+        return keyname, [i for i in group if i != instance]
+
+
+@contextlib.contextmanager
+def share_keypairs(config, instances):
+    """
+    Shares a keypair between those of `instances` without one which are
+    built in the same region and account, while they are being made. The
+    keypair is deleted once the last of them is cleaned.
+    """
+    targets = collections.defaultdict(list)
+    for instance in instances:
+        if 'keyname' in state_backend().load(instance):
+            continue
+        build = config[instance]['build']
+        targets[(build.get('region'), build.get('role_arn'))].append(instance)
+
+    SharedKeypairs.current = SharedKeypairs(
+        tuple(group) for group in targets.values() if len(group) > 1)
+    try:
+        yield
+    finally:
+        SharedKeypairs.current = None
+
+
+def result_status(result):
+    if result['status'] == 0:
+        return 'ok'
+    if result['error']:
+        return 'failed: {}'.format(result['error'])
+    return 'failed with status {}'.format(result['status'])
+
+
+def summarize(results):
+    longest = sorted(len(r['instance']) for r in results)[-1]
+    for result in results:
+        print('{:{width}}{:>8.1f}s  {}  {}'.format(
+            result['instance'], result['duration'], result['log'],
+            result_status(result), width=longest+4))
 
 
+@timed_command('clean-build')
+@targeted
 def clean_build(instance):
     clean_instance(instance, 'build')
 
 
+@timed_command('clean-test')
+@targeted
 def clean_test(instance):
     clean_instance(instance, 'test')
 
@@ -636,7 +2152,8 @@ def clean_instance(instance, phase):
             return
 
         ec2_instance = ec2_connect().Instance(id=state[phase]['id'])
-        ec2_instance.terminate()
+        with timed('terminate'):
+            ec2_instance.terminate()
         print('Deleted instance {}'.format(ec2_instance.id))
         del(state[phase])
 
@@ -648,33 +2165,334 @@ def clean_instance(instance, phase):
             delete_keypair(state)
 
     if 'build' not in state and 'image' not in state and 'test' not in state:
+        with load_state(instance) as state:
+            state.pop('target', None)
         delete_files(instance_files(instance))
+        shutil.rmtree(facts_dir(instance), ignore_errors=True)
 
 
+@timed_command('clean-image')
+@targeted
 def clean_image(instance):
     with load_state(instance) as state:
         if 'image' not in state:
             print('No image found for {}'.format(instance))
             return
 
-        (image,) = ec2_connect().images.filter(ImageIds=[state['image']['id']])
-        image.deregister()
-        print('Deregistered image {}'.format(state['image']['id']))
+        # An image which was reused belongs to another build, so it is
+        # only forgotten, but copies made of it for this instance are not.
+        if state['image'].get('reused'):
+            print('Forgot image {}, which was not built for {}'.format(
+                state['image']['id'], instance))
+        else:
+            with timed('deregister'):
+                delete_image(ec2_connect().meta.client, state['image']['id'])
+            print('Deregistered image {}'.format(state['image']['id']))
+
+        role_arn = current_target()[1]
+        for region, copy_id in sorted(made_copies(state['image']).items()):
+            with session_target(region, role_arn), timed('deregister'):
+                delete_image(ec2_connect().meta.client, copy_id)
+            print('Deregistered image {} in {}'.format(copy_id, region))
         del(state['image'])
 
     if 'build' not in state and 'test' not in state:
+        with load_state(instance) as state:
+            # A keypair is normally deleted with the last instance, but
+            # a build that was skipped may have left one.
+            if 'keyname' in state:
+                delete_keypair(state)
+            state.pop('target', None)
+        delete_files(instance_files(instance))
+        shutil.rmtree(facts_dir(instance), ignore_errors=True)
+
+
+def made_copies(image):
+    """
+    Returns the copies, by region, of `image` from an instance's state
+    which were made for the instance rather than found in their region.
+    """
+    return dict((region, copy_id)
+                for region, copy_id in image.get('copies', {}).items()
+                if region in image.get('copied', []))
+
+
+TERMINATE_BATCH = 1000
+
+# Errors meaning that a resource being deleted is already gone
+GONE_ERRORS = (
+    'InvalidInstanceID.NotFound',
+    'InvalidAMIID.NotFound',
+    'InvalidAMIID.Unavailable',
+    'InvalidKeyPair.NotFound',
+)
+
+
+def clean_all(instances, wait=False, jobs=8):
+    """
+    Deletes the build and test instances, images and keypairs of all of
+    `instances` at once. Instances are terminated in batches, and images
+    and keypairs are deleted in parallel, up to `jobs` at a time, for each
+    region and role they were made with. The state and files of each
+    instance are removed once all of its resources are deleted. Returns
+    the instances which could not be cleaned.
+    """
+    targets = collections.defaultdict(list)
+    for instance in instances:
+        state = state_backend().load(instance)
+        if not state:
+            continue
+        target = state.get('target') or {}
+        targets[(target.get('region'), target.get('role_arn'))].append(
+            (instance, state))
+
+    failed = []
+    for (region, role_arn), states in sorted(targets.items()):
+        with session_target(region, role_arn):
+            failed.extend(clean_target(states, wait, jobs))
+
+    for instance in instances:
+        if instance in failed:
+            continue
+        with load_state(instance) as state:
+            state.clear()
         delete_files(instance_files(instance))
+        shutil.rmtree(facts_dir(instance), ignore_errors=True)
+    return sorted(failed)
+
+
+def clean_target(states, wait, jobs):
+    """
+    Deletes the resources in `states`, a list of instances and their
+    states, in the current region. Returns the instances for which any
+    deletion failed.
+    """
+    failed = set()
+    region, role_arn = current_target()
+    client = ec2_connect().meta.client
+
+    instance_ids = [(instance, state[phase]['id'])
+                    for instance, state in states
+                    for phase in ('build', 'test') if phase in state]
+    terminated = []
+    for i in range(0, len(instance_ids), TERMINATE_BATCH):
+        batch = instance_ids[i:i + TERMINATE_BATCH]
+        batch_failed, batch_terminated = terminate_instances(client, batch)
+        failed.update(batch_failed)
+        terminated.extend(batch_terminated)
+
+    def deregister(image_region, image_id):
+        with session_target(image_region or region, role_arn):
+            delete_image(ec2_connect().meta.client, image_id)
+        print('Deregistered image {}'.format(image_id))
+
+    def delete_keypair(keyname):
+        with session_target(region, role_arn):
+            ec2_connect().meta.client.delete_key_pair(KeyName=keyname)
+        print('Deleted keypair {}'.format(keyname))
+
+    tasks = []
+    for instance, state in states:
+        if 'image' not in state:
+            continue
+        if not state['image'].get('reused'):
+            tasks.append((instance, deregister, region, state['image']['id']))
+        for copy_region, copy_id in made_copies(state['image']).items():
+            tasks.append((instance, deregister, copy_region, copy_id))
+    cleaned = set(instance for instance, _ in states)
+    keynames = set()
+    for instance, state in states:
+        keyname = state.get('keyname')
+        if (keyname and keyname not in keynames and
+                not keypair_in_use(state, ignore=cleaned)):
+            keynames.add(keyname)
+            tasks.append((instance, delete_keypair, keyname))
+
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        submitted = {
+            executor.submit(task[1], *task[2:]): task[0] for task in tasks
+        }
+        for future in futures.as_completed(submitted):
+            e = future.exception()
+            if e and not is_gone(e):
+                print('Error cleaning {}: {}'.format(submitted[future], e))
+                failed.add(submitted[future])
+
+    # Instances which were already gone cannot be described, so only
+    # those terminated here are waited on.
+    if wait and terminated:
+        ec2 = ec2_connect()
+
+        def all_terminated():
+            instances = ec2.instances.filter(InstanceIds=terminated)
+            if all(i.state['Name'] == 'terminated' for i in instances):
+                return True
+
+        with Spinner('instances', 'to be terminated'):
+            wait_until(all_terminated, Backoff(5, maximum=15))
+    return failed
+
+
+def terminate_instances(client, batch):
+    """
+    Terminates the EC2 instances in `batch`, a list of instances and EC2
+    instance IDs, with one request. If any of them no longer exists, the
+    others are terminated one at a time. Returns the instances for which
+    termination failed, and the IDs of the EC2 instances terminated.
+    """
+    try:
+        client.terminate_instances(InstanceIds=[i for _, i in batch])
+    except botocore.exceptions.ClientError as e:
+        if not is_gone(e):
+            print('Error terminating {}: {}'.format(
+                ', '.join(i for _, i in batch), e))
+            return set(instance for instance, _ in batch), []
+        if len(batch) == 1:
+            return set(), []
+        failed, terminated = set(), []
+        for item in batch:
+            item_failed, item_terminated = terminate_instances(client, [item])
+            failed.update(item_failed)
+            terminated.extend(item_terminated)
+        return failed, terminated
+
+    for _, ident in batch:
+        print('Deleted instance {}'.format(ident))
+    return set(), [ident for _, ident in batch]
+
+
+def is_gone(e):
+    return (isinstance(e, botocore.exceptions.ClientError) and
+            e.response.get('Error', {}).get('Code') in GONE_ERRORS)
+
+
+def delete_image(client, image_id, snapshots=None, jobs=4):
+    """
+    Deregisters the image `image_id` and deletes the EBS snapshots behind
+    it, in parallel. The snapshots are looked up if they are not given.
+    """
+    if snapshots is None:
+        images = client.describe_images(ImageIds=[image_id])['Images']
+        snapshots = image_snapshots(
+            images[0]['BlockDeviceMappings'] if images else [])
+    client.deregister_image(ImageId=image_id)
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        deleting = [executor.submit(client.delete_snapshot, SnapshotId=s)
+                    for s in snapshots]
+        for future in deleting:
+            future.result()
+    for snapshot in snapshots:
+        print('Deleted snapshot {}'.format(snapshot))
+
+
+def image_snapshots(block_device_mappings):
+    return [m['Ebs']['SnapshotId'] for m in block_device_mappings or []
+            if m.get('Ebs', {}).get('SnapshotId')]
+
+
+def expired_images(images, keep=None, days=None, now=None):
+    """
+    Returns the images which fall outside of the retention policy: the
+    newest `keep` images of each role, platform and profile are kept, as
+    is every image created within the last `days` days. Images are grouped
+    by their bossimage tags.
+    """
+    now = now or datetime.datetime.utcnow()
+    groups = collections.defaultdict(list)
+    for image in images:
+        tags = dict((tag['Key'], tag['Value']) for tag in image.tags or [])
+        groups[tuple(tags.get('bossimage:{}'.format(k))
+                     for k in ('role', 'platform', 'profile'))].append(image)
+
+    expired = []
+    for _, group in sorted(groups.items()):
+        group.sort(key=lambda i: i.creation_date, reverse=True)
+        for index, image in enumerate(group):
+            if keep is not None and index < keep:
+                continue
+            created = datetime.datetime.strptime(
+                image.creation_date[:19], '%Y-%m-%dT%H:%M:%S')
+            if days is not None and now - created < datetime.timedelta(days):
+                continue
+            expired.append(image)
+    return expired
+
+
+def gc(config, keep=None, days=None, dry_run=False, all_roles=False, jobs=8):
+    """
+    Deletes the images tagged by bossimage which fall outside of the
+    retention policy of `expired_images`, along with their snapshots, in
+    every region and account that `config` builds in or copies to. Only
+    images of the current role are considered unless `all_roles` is set,
+    and images in the state of any instance are always kept. Returns the
+    images which were, or with `dry_run` would be, deleted.
+    """
+    targets, protected = set(), set()
+    for instance, instance_config in config.items():
+        build = instance_config['build']
+        target = (build.get('region') or None, build.get('role_arn') or None)
+        targets.add(target)
+        for region in instance_config['image'].get('copy_to', []):
+            targets.add((region, target[1]))
+        image = state_backend().load(instance).get('image', {})
+        protected.update([image.get('id')] + image.get('copies', {}).values())
+
+    if all_roles:
+        filters = [{'Name': 'tag-key', 'Values': ['bossimage:role']}]
+    else:
+        filters = [{'Name': 'tag:bossimage:role', 'Values': [role_name()]}]
+
+    deleted = []
+    for region, role_arn in sorted(targets):
+        with session_target(region, role_arn):
+            ec2 = ec2_connect()
+            images = ec2.images.filter(Owners=['self'], Filters=filters)
+            expired = [i for i in expired_images(images, keep, days)
+                       if i.id not in protected]
+            for image in expired:
+                print('{} {} {} {}'.format(
+                    'Would delete' if dry_run else 'Deleting',
+                    image.id, image.name, image.creation_date))
+            if not dry_run:
+                client = ec2.meta.client
+                with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                    deleting = [executor.submit(
+                        delete_image, client, i.id,
+                        image_snapshots(i.block_device_mappings))
+                        for i in expired]
+                    for future in deleting:
+                        future.result()
+            deleted.extend(expired)
+    return deleted
 
 
 def delete_keypair(state):
-    kp = ec2_connect().KeyPair(name=state['keyname'])
-    kp.delete()
-    print('Deleted keypair {}'.format(kp.name))
+    if keypair_in_use(state):
+        print('Keeping keypair {}, which is shared with {}'.format(
+            state['keyname'], ', '.join(state['shared_with'])))
+    else:
+        kp = ec2_connect().KeyPair(name=state['keyname'])
+        with timed('delete-keypair'):
+            kp.delete()
+        print('Deleted keypair {}'.format(kp.name))
     del(state['keyname'])
+    state.pop('shared_with', None)
+
+
+def keypair_in_use(state, ignore=()):
+    """
+    Returns whether any instance, other than those in `ignore`, still uses
+    the keypair which `state` shares with it.
+    """
+    return any(
+        state_backend().load(other).get('keyname') == state['keyname']
+        for other in state.get('shared_with', []) if other not in ignore)
 
 
 def delete_files(files):
     for f in files.values():
+        if not os.path.exists(f):
+            continue
         try:
             os.unlink(f)
         except OSError:
@@ -682,16 +2500,17 @@ def delete_files(files):
 
 
 def statuses(config):
-    def exists(instance):
-        return os.path.exists('.boss/{}-state.yml'.format(instance))
-    return [(instance, exists(instance)) for instance in config.keys()]
+    created = state_backend().existing(config.keys())
+    return [(instance, instance in created) for instance in config.keys()]
 
 
 def login(instance, config, phase='build'):
     files = instance_files(instance)
 
-    with open(files['state']) as f:
-        state = yaml.load(f)
+    state = state_backend().load(instance)
+    if 'ip' not in state.get(phase, {}):
+        raise StateError('No running {} instance for {}'.format(
+            phase, instance))
 
     ssh = subprocess.Popen([
         'ssh', '-i', files['keyfile'],
@@ -706,27 +2525,280 @@ def instance_files(instance):
         keyfile='.boss/{}.pem'.format(instance),
         inventory='.boss/{}.inventory'.format(instance),
         playbook='.boss/{}-playbook.yml'.format(instance),
+        ansible_cfg='.boss/{}-ansible.cfg'.format(instance),
     )
 
 
+def facts_dir(instance):
+    """
+    Returns the directory in which Ansible caches the facts of `instance`.
+    """
+    inventory = instance_files(instance)['inventory']
+    return os.path.join(os.path.dirname(inventory), '{}-facts'.format(instance))
+
+
 @contextlib.contextmanager
 def load_state(instance):
-    files = instance_files(instance)
-    if not os.path.exists(files['state']):
+    with instance_lock(instance):
+        with state_backend().transaction(instance) as state:
+            yield state
+
+
+# Seconds to wait for another process to release the lock on an instance.
+LOCK_TIMEOUT = 300
+
+
+class InstanceLock(object):
+    """
+    Counts the locks held by the current thread, so that a thread which
+    already holds the lock on an instance may take it again.
+    """
+    local = t.local()
+
+    @classmethod
+    def held(cls):
+        if not hasattr(cls.local, 'held'):
+            cls.local.held = collections.defaultdict(int)
+        return cls.local.held
+
+
+@contextlib.contextmanager
+def instance_lock(instance, timeout=None):
+    """
+    Takes an exclusive advisory lock on `instance`, shared with any other
+    bossimage process working in the same directory, for as long as its
+    state or inventory is being changed.
+    """
+    path = '{}.lock'.format(instance_files(instance)['state'])
+    held = InstanceLock.held()
+    if held[path]:
+        held[path] += 1
+        try:
+            yield
+        finally:
+            held[path] -= 1
+        return
+
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    timeout = LOCK_TIMEOUT if timeout is None else timeout
+    end = time.time() + timeout
+    with open(path, 'a') as f:
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                if time.time() > end:
+                    raise LockTimeout(
+                        'Timeout after {}s waiting for lock on {}'.format(
+                            timeout, instance))
+                time.sleep(0.1)
+        held[path] += 1
+        try:
+            yield
+        finally:
+            held[path] -= 1
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class YamlState(object):
+    """
+    Keeps the state of each instance in its own YAML file under .boss.
+    """
+    def load(self, instance):
+        path = instance_files(instance)['state']
+        if not os.path.exists(path):
+            return dict()
+        with open(path) as f:
+            return yaml.safe_load(f) or dict()
+
+    def save(self, instance, state):
+        path = instance_files(instance)['state']
+        write_atomic(path, yaml.safe_dump(state))
+
+    @contextlib.contextmanager
+    def transaction(self, instance):
+        state = self.load(instance)
+        original = copy.deepcopy(state)
+        yield state
+        if state != original:
+            self.save(instance, state)
+
+    def existing(self, instances):
+        return set(instance for instance in instances
+                   if os.path.exists(instance_files(instance)['state']))
+
+
+class SqliteState(object):
+    """
+    Keeps the state of all instances in a single SQLite database. The
+    state is read and saved in separate, short SQL transactions, so the
+    database is never locked while an instance is being worked on; the
+    lock on the instance taken by `load_state` keeps concurrent updates of
+    one instance from interleaving.
+    The keyname of an instance is stored with the instance, and each of
+    the other keys of its state, such as `build`, `image` and `test`, in
+    its own row of the `phases` table.
+    """
+    schema = [
+        '''CREATE TABLE IF NOT EXISTS instances (
+            name TEXT PRIMARY KEY,
+            keyname TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS phases (
+            instance TEXT NOT NULL,
+            phase TEXT NOT NULL,
+            resource_id TEXT,
+            data TEXT NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (instance, phase)
+        )''',
+        '''CREATE INDEX IF NOT EXISTS phases_resource_id
+            ON phases (resource_id)''',
+    ]
+
+    def __init__(self, path='.boss/state.db', timeout=30):
+        self.path = path
+        self.timeout = timeout
+
+    @contextlib.contextmanager
+    def connect(self, write=False):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+            try:
+                for statement in self.schema:
+                    conn.execute(statement)
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def read(self, conn, instance):
         state = dict()
-    else:
-        with open(files['state']) as f:
-            state = yaml.safe_load(f)
-    yield state
-    with open(files['state'], 'w') as f:
-        f.write(yaml.safe_dump(state))
+        row = conn.execute('SELECT keyname FROM instances WHERE name = ?',
+                           (instance,)).fetchone()
+        if row and row[0]:
+            state['keyname'] = str(row[0])
+        rows = conn.execute(
+            'SELECT phase, data FROM phases WHERE instance = ?', (instance,))
+        for phase, data in rows:
+            state[str(phase)] = from_json(json.loads(data))
+        return state
+
+    def write(self, conn, instance, state):
+        now = time.time()
+        if not state:
+            conn.execute('DELETE FROM phases WHERE instance = ?', (instance,))
+            conn.execute('DELETE FROM instances WHERE name = ?', (instance,))
+            return
+        conn.execute(
+            '''INSERT OR IGNORE INTO instances (name, created, updated)
+            VALUES (?, ?, ?)''', (instance, now, now))
+        conn.execute(
+            'UPDATE instances SET keyname = ?, updated = ? WHERE name = ?',
+            (state.get('keyname'), now, instance))
+        phases = {k: v for k, v in state.items() if k != 'keyname'}
+        conn.execute(
+            'DELETE FROM phases WHERE instance = ? AND phase NOT IN ({})'.format(
+                ', '.join('?' * len(phases))),
+            [instance] + phases.keys())
+        for phase, data in phases.items():
+            resource_id = data.get('id') if isinstance(data, dict) else None
+            conn.execute(
+                '''INSERT OR REPLACE INTO phases
+                (instance, phase, resource_id, data, updated)
+                VALUES (?, ?, ?, ?, ?)''',
+                (instance, phase, resource_id, json.dumps(data), now))
+
+    def load(self, instance):
+        if not os.path.exists(self.path):
+            return YamlState().load(instance)
+        with self.connect() as conn:
+            state = self.read(conn, instance)
+        return state or YamlState().load(instance)
+
+    @contextlib.contextmanager
+    def transaction(self, instance):
+        with self.connect() as conn:
+            state = self.read(conn, instance)
+        # State kept in YAML by an earlier version is imported the
+        # first time the instance is used.
+        imported = not state and YamlState().load(instance)
+        if imported:
+            state = imported
+        original = dict() if imported else copy.deepcopy(state)
+        yield state
+        if state != original:
+            with self.connect(write=True) as conn:
+                self.write(conn, instance, state)
+        if imported:
+            os.unlink(instance_files(instance)['state'])
+
+    def existing(self, instances):
+        if not os.path.exists(self.path):
+            return YamlState().existing(instances)
+        with self.connect() as conn:
+            names = set(str(row[0]) for row in
+                        conn.execute('SELECT name FROM instances'))
+        return (names & set(instances)) | YamlState().existing(instances)
+
+
+STATE_BACKENDS = dict(
+    yaml=YamlState,
+    sqlite=SqliteState,
+)
 
 
-def resource_id_for(collection, collection_desc, name, prefix, flt):
+@cached
+def state_backend():
+    name = os.getenv('BI_STATE_BACKEND', 'yaml')
+    if name not in STATE_BACKENDS:
+        raise ConfigurationError(
+            'Unknown state backend {}, must be one of {}'.format(
+                name, ', '.join(sorted(STATE_BACKENDS))))
+    return STATE_BACKENDS[name]()
+
+
+def import_state(instances):
+    """
+    Moves the YAML state of each of `instances` into the SQLite backend,
+    returning the names of those that were imported.
+    """
+    imported = sorted(YamlState().existing(instances))
+    backend = SqliteState()
+    for instance in imported:
+        with backend.transaction(instance):
+            pass
+    return imported
+
+
+def resource_id_for(collection, collection_desc, name, prefix, flt, ttl):
     if name.startswith(prefix):
         return name
+
+    cache = resolution_cache()
+    key = resolution_key(collection_desc, name)
+    ident = cache.get(key)
+    if ident:
+        return ident
+
     item = list(collection.filter(Filters=[flt]))
     if item:
+        cache.set(key, item[0].id, cache_ttl(ttl))
         return item[0].id
     else:
         desc = '{} "{}"'.format(collection_desc, name)
@@ -737,7 +2809,7 @@ def ami_id_for(name):
     ec2 = ec2_connect()
     return resource_id_for(
         ec2.images, 'image', name, 'ami-',
-        {'Name': 'name', 'Values': [name]}
+        {'Name': 'name', 'Values': [name]}, 7 * DAY,
     )
 
 
@@ -745,18 +2817,213 @@ def sg_id_for(name):
     ec2 = ec2_connect()
     return resource_id_for(
         ec2.security_groups, 'security group', name, 'sg-',
-        {'Name': 'group-name', 'Values': [name]}
+        {'Name': 'group-name', 'Values': [name]}, DAY,
     )
 
 
 def subnet_id_for(name):
     ec2 = ec2_connect()
     return resource_id_for(
-        ec2.subnets, 'subnet ', name, 'subnet-',
-        {'Name': 'tag:Name', 'Values': [name]}
+        ec2.subnets, 'subnet', name, 'subnet-',
+        {'Name': 'tag:Name', 'Values': [name]}, DAY,
     )
 
 
+def resolution_key(collection_desc, name):
+    return '{}:{}:{}'.format(resolution_scope(), collection_desc, name)
+
+
+def preresolve(config, instances):
+    """
+    Looks up the IDs of all AMI, security group and subnet names used by
+    `instances` with one request for each type of resource in each region
+    and account, and stores them in the resolution cache for
+    `resource_id_for` to find. Names which are not found are left for
+    `resource_id_for` to report.
+    """
+    targets = collections.defaultdict(list)
+    for instance in instances:
+        build = config[instance]['build']
+        targets[(build.get('region'), build.get('role_arn'))].append(instance)
+    for (region, role_arn), targeted_instances in sorted(targets.items()):
+        with session_target(region, role_arn):
+            preresolve_target(config, targeted_instances)
+
+
+def preresolve_target(config, instances):
+    names = dict(image=set(), sg=set(), subnet=set())
+    for instance in instances:
+        for phase in ('build', 'test'):
+            phase_config = config[instance][phase]
+            if 'source_ami' in phase_config:
+                names['image'].add(phase_config['source_ami'])
+            if phase_config['subnet']:
+                names['subnet'].add(phase_config['subnet'])
+            names['sg'].update(phase_config['security_groups'])
+
+    cache = resolution_cache()
+    kind_descs = dict(image='image', sg='security group', subnet='subnet')
+
+    def unresolved(kind, prefix):
+        return sorted(
+            name for name in names[kind] if not name.startswith(prefix)
+            and not cache.get(resolution_key(kind_descs[kind], name)))
+
+    def store(kind, resolved, ttl):
+        for name, ident in resolved.items():
+            key = resolution_key(kind_descs[kind], name)
+            cache.set(key, ident, cache_ttl(ttl))
+
+    ec2 = ec2_connect()
+
+    image_names = unresolved('image', 'ami-')
+    if image_names:
+        images = ec2.images.filter(
+            Filters=[{'Name': 'name', 'Values': image_names}])
+        store('image', {i.name: i.id for i in images}, 7 * DAY)
+
+    sg_names = unresolved('sg', 'sg-')
+    if sg_names:
+        sgs = ec2.security_groups.filter(
+            Filters=[{'Name': 'group-name', 'Values': sg_names}])
+        store('sg', {sg.group_name: sg.id for sg in sgs}, DAY)
+
+    subnet_names = unresolved('subnet', 'subnet-')
+    if subnet_names:
+        subnets = ec2.subnets.filter(
+            Filters=[{'Name': 'tag:Name', 'Values': subnet_names}])
+        store('subnet', {
+            tag['Value']: subnet.id for subnet in subnets
+            for tag in subnet.tags or [] if tag['Key'] == 'Name'
+        }, DAY)
+
+
+DAY = 24 * 60 * 60
+
+
+def cache_dir():
+    default = os.path.join(
+        os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+        'bossimage')
+    return os.getenv('BI_CACHE_DIR', default)
+
+
+def cache_ttl(default):
+    ttl = os.getenv('BI_CACHE_TTL')
+    return int(ttl) if ttl else default
+
+
+def clear_caches():
+    if os.path.exists(cache_dir()):
+        shutil.rmtree(cache_dir())
+    resolution_cache().clear()
+
+
+def write_atomic(path, content, mode=None):
+    """
+    Writes `content` to a temporary file next to `path` and renames it
+    into place, so that readers never see a partially written file.
+    """
+    dirname = os.path.dirname(path) or '.'
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+class DiskCache(object):
+    """
+    A JSON file of values which expire after a time to live, along with
+    counts of hits and misses across runs. Hits and misses are counted in
+    memory, and only written along with changes to the entries.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = t.Lock()
+        self.data = None
+        self.counts = dict(hits=0, misses=0)
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict(entries={}, hits=0, misses=0)
+
+    def load(self):
+        if self.data is None:
+            self.data = self.read()
+        return self.data
+
+    def save(self, key, entry):
+        """
+        Sets `key` to `entry`, or removes it if `entry` is None and it has
+        expired, in the file as it is now, so that entries and counts
+        written by other processes since it was loaded are kept.
+        """
+        data = self.read()
+        entries = data['entries']
+        if entry is not None:
+            entries[key] = entry
+        elif key in entries and entries[key]['expires'] <= time.time():
+            del(entries[key])
+        for name, count in self.counts.items():
+            data[name] += count
+            self.counts[name] = 0
+        write_atomic(self.path, json.dumps(data))
+        self.data = data
+
+    def get(self, key):
+        with self.lock:
+            entry = self.load()['entries'].get(key)
+            if entry and entry['expires'] > time.time():
+                self.counts['hits'] += 1
+                return entry['value']
+            self.counts['misses'] += 1
+            if entry:
+                self.save(key, None)
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.save(key, dict(value=value, expires=time.time() + ttl))
+
+    def clear(self):
+        with self.lock:
+            self.data = None
+            self.counts = dict(hits=0, misses=0)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def stats(self):
+        with self.lock:
+            data = self.load()
+            now = time.time()
+            return dict(
+                entries=len([e for e in data['entries'].values()
+                             if e['expires'] > now]),
+                hits=data['hits'] + self.counts['hits'],
+                misses=data['misses'] + self.counts['misses'],
+            )
+
+
+@cached
+def resolution_cache():
+    return DiskCache(os.path.join(cache_dir(), 'resolve.json'))
+
+
+def resolution_scope():
+    entry = session_pool().get(*current_target())
+    return '{}:{}'.format(entry.region, entry.account)
+
+
 def load_config(path='.boss.yml'):
     loader = j.FileSystemLoader('.')
     pre_validate = pre_merge_schema()
@@ -788,10 +3055,15 @@ def load_config(path='.boss.yml'):
 def load_config_v2(path='.boss.yml'):
     loader = j.FileSystemLoader('.')
     try:
-        template = loader.load(j.Environment(), path, os.environ)
-        yml = template.render()
-        doc = yaml.load(yml)
-        return transform_config(doc)
+        env = j.Environment()
+        source, _, _ = loader.get_source(env, path)
+        validated = cached_config(source)
+        if validated is None:
+            template = loader.load(env, path, os.environ)
+            yml = template.render()
+            validated = validate_v2(yaml.load(yml))
+            cache_config(env, source, validated)
+        return InstanceConfig(validated)
     except j.TemplateNotFound:
         error = 'Error loading {}: not found'.format(path)
         raise ConfigurationError(error)
@@ -806,6 +3078,73 @@ def load_config_v2(path='.boss.yml'):
         raise ConfigurationError(error)
 
 
+def config_cache_path(source):
+    digest = hashlib.sha1(b.__version__ + source.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir(), 'config', '{}.json'.format(digest))
+
+
+def environ_digest(names):
+    environ = {name: os.environ.get(name) for name in names}
+    return hashlib.sha1(json.dumps(environ, sort_keys=True)).hexdigest()
+
+
+def cached_config(source):
+    """
+    Returns the validated configuration for the template `source` if it
+    has been cached with the current values of the environment variables
+    that the template uses, otherwise None.
+    """
+    try:
+        with open(config_cache_path(source)) as f:
+            entry = json.load(f)
+    except (IOError, ValueError):
+        return None
+    configs = dict(entry['configs'])
+    return from_json(configs.get(environ_digest(entry['environ'])))
+
+
+def cache_config(env, source, config, keep=16):
+    ast = env.parse(source)
+    # Changes to included templates would not be noticed, so skip caching.
+    if list(jmeta.find_referenced_templates(ast)):
+        return
+    path = config_cache_path(source)
+    names = sorted(jmeta.find_undeclared_variables(ast))
+    # JSON cannot hold all of the types YAML loads, such as dates and
+    # integer keys, and a configuration using them is not cached, so that
+    # a cached configuration is always the same as one just loaded.
+    try:
+        if from_json(json.loads(json.dumps(config))) != config:
+            return
+    except (TypeError, ValueError):
+        return
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (IOError, ValueError):
+        entry = dict(environ=names, configs=[])
+    entry['configs'].append([environ_digest(names), config])
+    entry['configs'] = entry['configs'][-keep:]
+    write_atomic(path, json.dumps(entry))
+
+
+def from_json(obj):
+    """
+    Converts the unicode strings returned by json to str where possible,
+    so that cached configuration matches that loaded from YAML.
+    """
+    if isinstance(obj, dict):
+        return {from_json(k): from_json(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [from_json(item) for item in obj]
+    elif isinstance(obj, unicode):
+        try:
+            return str(obj)
+        except UnicodeEncodeError:
+            return obj
+    return obj
+
+
 def merge_config(c):
     merged = {}
     for platform in c['platforms']:
@@ -853,187 +3192,206 @@ def is_volume_type(s):
     return s
 
 
-def pre_merge_schema():
-    default_profiles = [{
-        'name': 'default',
-        'extra_vars': {}
-    }]
-    return v.Schema({
-        v.Optional('driver', default={}): {v.Extra: object},
-        v.Required('platforms'): [{
-            v.Required('name'): str,
-        }],
-        v.Optional('profiles', default=default_profiles): [{
-            v.Required('name'): str,
-        }],
-    }, extra=v.ALLOW_EXTRA)
+def merge_schemas(*schemas):
+    merged = {}
+    for schema in schemas:
+        merged.update(schema)
+    return merged
 
 
-def validate_v2(doc):
-    base = {
-        v.Optional('instance_type'): str,
-        v.Optional('username'): str,
-        v.Optional('connection'): v.Or('ssh', 'winrm'),
-        v.Optional('connection_timeout'): int,
-        v.Optional('port'): int,
-        v.Optional('associate_public_ip_address'): bool,
-        v.Optional('subnet'): str,
-        v.Optional('security_groups'): [str],
-        v.Optional('iam_instance_profile'): str,
-        v.Optional('tags'): {str: str},
-        v.Optional('user_data'): v.Or(
-            str,
-            {'file': str},
-        ),
-        v.Optional('block_device_mappings'): [{
-            v.Required('device_name'): str,
-            'ebs': {
-                'volume_size': int,
-                'volume_type': is_volume_type,
-                'delete_on_termination': bool,
-                'encrypted': bool,
-                'iops': int,
-                'snapshot_id': is_snapshot_id,
-            },
-            'no_device': str,
-            'virtual_name': is_virtual_name,
-        }],
-    }
-    defaults = {
-        v.Optional('instance_type', default='t2.micro'): str,
-        v.Optional('username', default='ec2-user'): str,
-        v.Optional('connection', default='ssh'): v.Or('ssh', 'winrm'),
-        v.Optional('connection_timeout', default=600): int,
-        v.Optional('port', default=22): int,
-        v.Optional('associate_public_ip_address', default=True): bool,
-        v.Optional('subnet', default=''): str,
-        v.Optional('security_groups', default=[]): [str],
-        v.Optional('iam_instance_profile', default=''): str,
-        v.Optional('tags', default={}): {str: str},
-        v.Optional('user_data', default=''): v.Or(
-            str,
-            {'file': str},
-        ),
-        v.Optional('block_device_mappings', default=[]): [{
-            v.Required('device_name'): str,
-            'ebs': {
-                'volume_size': int,
-                'volume_type': is_volume_type,
-                'delete_on_termination': bool,
-                'encrypted': bool,
-                'iops': int,
-                'snapshot_id': is_snapshot_id,
-            },
-            'no_device': str,
-            'virtual_name': is_virtual_name,
-        }],
-    }
-    build = base.copy()
-    build.update({
-        v.Required('source_ami'): str,
-        v.Optional('become', default=True): bool,
-        v.Optional('extra_vars', default={}): dict,
-    })
-    image = {
-        v.Optional('ami_name'): str,
+def instance_schema(defaults, exclude=()):
+    """
+    Returns the schema of the settings shared by every instance, with
+    default values filled in if `defaults` is true.
+    """
+    return {
+        v.Optional(k, default=d) if defaults else v.Optional(k): schema
+        for k, schema, d in INSTANCE_SETTINGS if k not in exclude
     }
-    test = base.copy()
-    test.update({
-        v.Optional('playbook', default='tests/test.yml'): str
-    })
-    platform = base.copy()
-    ami_name = '%(role)s.%(profile)s.%(platform)s.%(vtype)s.%(arch)s.%(version)s'
-    platform.update({
+
+
+AMI_NAME = '%(role)s.%(profile)s.%(platform)s.%(vtype)s.%(arch)s.%(version)s'
+
+USER_DATA = v.Or(
+    str,
+    {'file': str},
+)
+
+BLOCK_DEVICE_MAPPINGS = [{
+    v.Required('device_name'): str,
+    'ebs': {
+        'volume_size': int,
+        'volume_type': is_volume_type,
+        'delete_on_termination': bool,
+        'encrypted': bool,
+        'iops': int,
+        'snapshot_id': is_snapshot_id,
+    },
+    'no_device': str,
+    'virtual_name': is_virtual_name,
+}]
+
+# Mutable defaults are given as callables so that each validated
+# document gets its own copy from the shared schemas.
+INSTANCE_SETTINGS = [
+    ('instance_type', str, 't2.micro'),
+    ('username', str, 'ec2-user'),
+    ('connection', v.Or('ssh', 'winrm'), 'ssh'),
+    ('connection_timeout', int, 600),
+    ('port', int, 22),
+    ('associate_public_ip_address', bool, True),
+    ('subnet', str, ''),
+    ('security_groups', [str], list),
+    ('iam_instance_profile', str, ''),
+    ('tags', {str: str}, dict),
+    ('user_data', USER_DATA, ''),
+    ('block_device_mappings', BLOCK_DEVICE_MAPPINGS, list),
+    ('ansible_config', {str: {str: v.Any(str, int, bool)}}, dict),
+    ('region', str, ''),
+    ('role_arn', str, ''),
+]
+
+PRE_MERGE_SCHEMA = v.Schema({
+    v.Optional('driver', default=dict): {v.Extra: object},
+    v.Required('platforms'): [{
         v.Required('name'): str,
-        v.Required('build'): build,
-        v.Optional('image', default={'ami_name': ami_name}): image,
-        v.Optional('test', default={'playbook': 'tests/test.yml'}): test,
-    })
-    profile = {
+    }],
+    v.Optional('profiles', default=lambda: [{
+        'name': 'default',
+        'extra_vars': {},
+    }]): [{
         v.Required('name'): str,
-        v.Optional('extra_vars', default={}): dict
-    }
-    return v.Schema({
-        v.Optional('defaults', default={}): defaults,
-        v.Required('platforms'): [platform],
-        v.Optional('profiles', default=[{
-            'name': 'default', 'extra_vars': {}
-        }]): [profile],
-    })(doc)
+    }],
+}, extra=v.ALLOW_EXTRA)
+
+POST_MERGE_SCHEMA = v.Schema({
+    str: merge_schemas(
+        instance_schema(True, ('instance_type', 'iam_instance_profile',
+                               'ansible_config', 'region', 'role_arn')),
+        {
+            'platform': str,
+            'profile': str,
+            v.Required('source_ami'): str,
+            v.Required('instance_type'): str,
+            v.Optional('extra_vars', default=dict): dict,
+            v.Optional('become', default=True): bool,
+            v.Optional('ami_name', default=AMI_NAME): str,
+        },
+    )
+})
 
+V2_SCHEMA = v.Schema({
+    v.Optional('defaults', default=dict): instance_schema(True),
+    v.Required('platforms'): [merge_schemas(instance_schema(False), {
+        v.Required('name'): str,
+        v.Required('build'): merge_schemas(instance_schema(False), {
+            v.Required('source_ami'): str,
+            v.Optional('become', default=True): bool,
+            v.Optional('extra_vars', default=dict): dict,
+            v.Optional('fanout', default=False): bool,
+            v.Optional('layers', default=list): [{
+                v.Required('name'): str,
+                v.Required('playbook'): str,
+                v.Optional('extra_vars', default=dict): dict,
+                v.Optional('inputs', default=list): [str],
+            }],
+        }),
+        v.Optional('image', default=lambda: {'ami_name': AMI_NAME}): {
+            v.Optional('ami_name'): str,
+            v.Optional('copy_to', default=list): [str],
+        },
+        v.Optional('test', default=lambda: {'playbook': 'tests/test.yml'}):
+            merge_schemas(instance_schema(False), {
+                v.Optional('playbook', default='tests/test.yml'): str,
+            }),
+    })],
+    v.Optional('profiles', default=lambda: [{
+        'name': 'default', 'extra_vars': {}
+    }]): [{
+        v.Required('name'): str,
+        v.Optional('extra_vars', default=dict): dict,
+    }],
+})
 
-def transform_config(doc):
-    validated = validate_v2(doc)
-    transformed = {}
-    excluded_items = ('name', 'build', 'image', 'test')
-    for platform in validated['platforms']:
-        for profile in validated['profiles']:
-            instance = '{}-{}'.format(platform['name'], profile['name'])
-            transformed[instance] = {}
 
-            transformed[instance]['build'] = validated['defaults'].copy()
-            transformed[instance]['build'].update({
-                k: v for k, v in platform.items() if k not in excluded_items
-            })
-            transformed[instance]['build'].update(platform['build'].copy())
-            transformed[instance]['build'].update({
-                'extra_vars':  profile['extra_vars'].copy(),
-                'platform': platform['name'],
-                'profile': profile['name'],
-            })
+def pre_merge_schema():
+    return PRE_MERGE_SCHEMA
 
-            transformed[instance]['image'] = platform['image'].copy()
-            transformed[instance]['image'].update({
-                'platform': platform['name'],
-                'profile': profile['name'],
-            })
 
-            transformed[instance]['test'] = validated['defaults'].copy()
-            transformed[instance]['test'].update({
-                k: v for k, v in platform.items() if k not in excluded_items
-            })
-            transformed[instance]['test'].update(platform['test'].copy())
+def post_merge_schema():
+    return POST_MERGE_SCHEMA
 
-            transformed[instance]['platform'] = platform['name']
-            transformed[instance]['profile'] = profile['name']
-    return transformed
 
+def validate_v2(doc):
+    return V2_SCHEMA(doc)
 
-def post_merge_schema():
-    ami_name = '%(role)s.%(profile)s.%(platform)s.%(vtype)s.%(arch)s.%(version)s'
-    return v.Schema({
-        str: {
-            'platform': str,
-            'profile': str,
-            v.Required('source_ami'): str,
-            v.Required('instance_type'): str,
-            v.Optional('extra_vars', default={}): dict,
-            v.Optional('username', default='ec2-user'): str,
-            v.Optional('become', default=True): bool,
-            v.Optional('ami_name', default=ami_name): str,
-            v.Optional('connection', default='ssh'): v.Or('ssh', 'winrm'),
-            v.Optional('connection_timeout', default=600): int,
-            v.Optional('port', default=22): int,
-            v.Optional('associate_public_ip_address', default=True): bool,
-            v.Optional('subnet', default=''): str,
-            v.Optional('security_groups', default=[]): [str],
-            v.Optional('tags', default={}): {str: str},
-            v.Optional('user_data', default=''): v.Or(
-                str,
-                {'file': str},
-            ),
-            v.Optional('block_device_mappings', default=[]): [{
-                v.Required('device_name'): str,
-                'ebs': {
-                    'volume_size': int,
-                    'volume_type': is_volume_type,
-                    'delete_on_termination': bool,
-                    'encrypted': bool,
-                    'iops': int,
-                    'snapshot_id': is_snapshot_id,
-                },
-                'no_device': str,
-                'virtual_name': is_virtual_name,
-            }],
-        }
+
+def transform_config(doc):
+    return InstanceConfig(validate_v2(doc))
+
+
+class InstanceConfig(collections.Mapping):
+    """
+    Maps the name of each instance to its configuration, which is expanded
+    from the validated platform and profile only when it is first accessed.
+    Listing instances does not expand any of them.
+    """
+    def __init__(self, validated):
+        self.validated = validated
+        self.instances = {}
+        for platform in validated['platforms']:
+            for profile in validated['profiles']:
+                instance = '{}-{}'.format(platform['name'], profile['name'])
+                self.instances[instance] = (platform, profile)
+        self.expanded = {}
+        self.lock = t.Lock()
+
+    def __getitem__(self, instance):
+        with self.lock:
+            if instance not in self.expanded:
+                platform, profile = self.instances[instance]
+                self.expanded[instance] = expand_instance(
+                    self.validated['defaults'], platform, profile)
+            return self.expanded[instance]
+
+    def __iter__(self):
+        return iter(self.instances)
+
+    def __len__(self):
+        return len(self.instances)
+
+    def __contains__(self, instance):
+        return instance in self.instances
+
+
+def expand_instance(defaults, platform, profile):
+    expanded = {}
+    excluded_items = ('name', 'build', 'image', 'test')
+
+    expanded['build'] = defaults.copy()
+    expanded['build'].update({
+        k: v for k, v in platform.items() if k not in excluded_items
+    })
+    expanded['build'].update(platform['build'].copy())
+    expanded['build'].update({
+        'extra_vars':  profile['extra_vars'].copy(),
+        'platform': platform['name'],
+        'profile': profile['name'],
     })
+
+    expanded['image'] = platform['image'].copy()
+    expanded['image'].update({
+        'platform': platform['name'],
+        'profile': profile['name'],
+    })
+
+    expanded['test'] = defaults.copy()
+    expanded['test'].update({
+        k: v for k, v in platform.items() if k not in excluded_items
+    })
+    expanded['test'].update(platform['test'].copy())
+
+    expanded['platform'] = platform['name']
+    expanded['profile'] = profile['name']
+    return expanded
+
@@ -29,6 +29,9 @@ config = {
         'ansible',
         'boto3',
         'click',
+        'cryptography',
+        'futures',
+        'paramiko',
         'pywinrm',
         'voluptuous',
     ],
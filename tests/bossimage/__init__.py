@@ -1,3 +1,4 @@
+import os
 import shutil
 import tempfile
 import time
@@ -11,6 +12,8 @@ tempdir = tempfile.mkdtemp()
 
 
 def setup():
+    os.environ['BI_CACHE_DIR'] = '{}/cache'.format(tempdir)
+    bc.resolution_scope = resolution_scope
     bc.create_working_dir = create_working_dir
     bc.instance_files = instance_files
     bc.ec2_connect = probe(ec2_connect)
@@ -48,11 +51,15 @@ def reset_probes(watch=[]):
     probe.watch = watch
 
 
+def resolution_scope():
+    return 'us-east-1:000000000000'
+
+
 def create_working_dir():
     pass
 
 
-def wait_for_connection(a, b, c, d, e, f):
+def wait_for_connection(a, b, c, d, e, f, g=None):
     time.sleep(1)
 
 
@@ -66,6 +73,7 @@ def instance_files(instance):
         keyfile='{}/{}.pem'.format(tempdir, instance),
         inventory='{}/{}.inventory'.format(tempdir, instance),
         playbook='{}/{}-playbook.yml'.format(tempdir, instance),
+        ansible_cfg='{}/{}-ansible.cfg'.format(tempdir, instance),
     )
 
 
@@ -74,7 +82,7 @@ def ec2_connect():
     return mock_ec2()
 
 
-def run_ansible(a, b, c, d, e):
+def run_ansible(a, b, c, d, e, f=None):
     pass
 
 
@@ -88,19 +96,23 @@ def mock_ec2():
     def create_tags(Resources=None, Tags=[]):
         pass
 
-    def create_instances(ImageId='', InstanceType='', MinCount='', MaxCount='',
+    def create_instances(ImageId='', InstanceType='', MinCount=1, MaxCount=1,
                          KeyName='', NetworkInterfaces=[], BlockDeviceMappings=[],
-                         UserData='', IamInstanceProfile=''):
-        instance = mock.Mock()
-        instance.id = 'i-00000001'
-        instance.private_ip_address = '10.20.30.40'
-        instance.public_ip_address = '20.30.40.50'
-        instance.load = lambda: None
-        instance.reload = lambda: None
-        instance.wait_until_running = lambda: time.sleep(1)
-        return [instance]
-
-    def images_filter(ImageIds='', Filters=[]):
+                         UserData='', IamInstanceProfile='',
+                         TagSpecifications=[]):
+        instances = []
+        for i in range(MaxCount):
+            instance = mock.Mock()
+            instance.id = 'i-{:08}'.format(i + 1)
+            instance.private_ip_address = '10.20.30.40'
+            instance.public_ip_address = '20.30.40.50'
+            instance.load = lambda: None
+            instance.reload = lambda: None
+            instance.wait_until_running = lambda: time.sleep(1)
+            instances.append(instance)
+        return instances
+
+    def images_filter(ImageIds='', Owners=[], Filters=[]):
         image = mock.Mock()
         image.id = 'ami-00000002'
         yield image
@@ -116,8 +128,12 @@ def mock_ec2():
         instance.architecture = 'x86_64'
         instance.hypervisor = 'xen'
         instance.virtualization_type = 'hvm'
+        instance.private_ip_address = '10.20.30.40'
+        instance.public_ip_address = '20.30.40.50'
         instance.create_image = create_image
         instance.load = lambda: None
+        instance.reload = lambda: None
+        instance.wait_until_running = lambda: None
         instance.password_data = lambda: {'PasswordData': 'uncrackable'}
         return instance
 
@@ -1,8 +1,23 @@
+import base64
+import ConfigParser
+import datetime
+import json
 import os
+import shutil
+import socket
 import tempfile
+import threading
+import time
 import StringIO
 
+import boto3
 import yaml
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from mock import mock
 from nose.tools import assert_equal, assert_raises
 from voluptuous import MultipleInvalid, TypeInvalid
 
@@ -278,10 +293,73 @@ def test_create_instance_tags():
     bc.create_instance_v2(config['win-2012r2-default']['build'], 'ami-00000000', 'mykey')
     assert_equal(probe.called, ['create_instances'])
 
-    # amz-2015092 config has tags
+    # amz-2015092 config has tags, which are set as the instance is launched
     reset_probes(['create_instances', 'create_tags'])
     bc.create_instance_v2(config['amz-2015092-default']['build'], 'ami-00000000', 'mykey')
-    assert_equal(probe.called, ['create_instances', 'create_tags'])
+    assert_equal(probe.called, ['create_instances'])
+
+    assert_equal(bc.tag_specifications({}), [])
+    assert_equal(bc.tag_specifications({'Name': 'x', 'Env': 'y'}), [
+        {'ResourceType': 'instance',
+         'Tags': [{'Key': 'Env', 'Value': 'y'}, {'Key': 'Name', 'Value': 'x'}]},
+        {'ResourceType': 'volume',
+         'Tags': [{'Key': 'Env', 'Value': 'y'}, {'Key': 'Name', 'Value': 'x'}]},
+    ])
+
+
+def test_launch_batcher():
+    calls = []
+    ec2 = bc.ec2_connect()
+    create_instances = ec2.create_instances
+
+    def counting_create_instances(**params):
+        calls.append((params['ImageId'], params['MaxCount']))
+        return create_instances(**params)
+
+    ec2.create_instances = counting_create_instances
+    try:
+        launched = []
+
+        def launch(image_id):
+            launched.append(bc.launch_instance(dict(ImageId=image_id)).id)
+
+        with bc.launch_batches(window=0.5):
+            threads = [threading.Thread(target=launch, args=(image_id,))
+                       for image_id in ('ami-1', 'ami-1', 'ami-1', 'ami-2')]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert_equal(bc.LaunchBatcher.current, None)
+    finally:
+        ec2.create_instances = create_instances
+
+    assert_equal(sorted(calls), [('ami-1', 3), ('ami-2', 1)])
+    assert_equal(sorted(launched),
+                 ['i-00000001', 'i-00000001', 'i-00000002', 'i-00000003'])
+
+
+def test_load_or_create_instance():
+    config = bc.load_config('tests/resources/boss-good.yml')
+    instance = 'amz-2015092-default'
+    for f in bc.instance_files(instance).values():
+        if os.path.exists(f):
+            os.unlink(f)
+
+    reset_probes(['create_keypair', 'create_instances'])
+    state = bc.load_or_create_instance(config[instance])
+    assert_equal(probe.called, ['create_keypair', 'create_instances'])
+    assert_equal(state['build'], {'id': 'i-00000001', 'ip': '20.30.40.50'})
+    # The state is kept by the state backend like that of `make build`
+    assert_equal(bc.state_backend().load(instance), state)
+
+    reset_probes(['create_keypair', 'create_instances'])
+    assert_equal(bc.load_or_create_instance(config[instance]), state)
+    assert_equal(probe.called, [])
+
+    with bc.load_state(instance) as state:
+        state.clear()
+    bc.delete_files(bc.instance_files(instance))
 
 
 def test_make_build():
@@ -298,6 +376,49 @@ def test_make_build():
     assert_equal(probe.called, ['run_ansible'])
 
 
+def test_make_build_waits_unlocked():
+    config = bc.load_config_v2('tests/resources/boss-v2.yml')
+    instance = 'win-2012r2-default'
+    ec2 = bc.ec2_connect()
+    locked = []
+
+    def Instance(id=''):
+        ec2_instance = Instance_orig(id=id)
+        ec2_instance.wait_until_running = lambda: locked.append(
+            ('running', any(bc.InstanceLock.held().values()),
+             bc.state_backend().load(instance)['build']))
+        return ec2_instance
+
+    def get_windows_password(ec2_instance, keyfile):
+        locked.append(('password', any(bc.InstanceLock.held().values())))
+        return 'secret'
+
+    Instance_orig, ec2.Instance = ec2.Instance, Instance
+    password_orig = bc.get_windows_password
+    bc.get_windows_password = get_windows_password
+    try:
+        bc.make_build(instance, config[instance]['build'], 1)
+    finally:
+        ec2.Instance, bc.get_windows_password = Instance_orig, password_orig
+
+    # The instance is recorded before it is running, and neither it nor
+    # its password is waited for under the lock
+    assert_equal(locked, [
+        ('running', False, {'id': 'i-00000001',
+                            'fingerprint': locked[0][2]['fingerprint']}),
+        ('password', False),
+    ])
+    state = bc.state_backend().load(instance)
+    assert_equal(state['build']['ip'], '20.30.40.50')
+    with bc.load_inventory(instance) as inventory:
+        assert('ansible_password=secret' in inventory['build'])
+
+    with bc.load_state(instance) as state:
+        bc.delete_keypair(state)
+        state.clear()
+    bc.delete_files(bc.instance_files(instance))
+
+
 def test_make_test():
     config = bc.load_config_v2('tests/resources/boss-v2.yml')
     instance = 'amz-2015092-default'
@@ -372,3 +493,1223 @@ def test_make_image_no_wait():
     reset_probes(['ec2_connect', 'wait_for_image'])
     bc.make_image(instance, config[instance]['image'], wait)
     assert_equal(probe.called, [])
+
+
+def test_make_many():
+    config = bc.load_config_v2('tests/resources/boss-v2.yml')
+    instances = ['amz-2015092-default', 'amz-2015092-nginx']
+    for instance in instances:
+        for f in bc.instance_files(instance).values():
+            if os.path.exists(f):
+                os.unlink(f)
+
+    cwd = os.getcwd()
+    try:
+        os.chdir(tempdir)
+        results = bc.make_many(bc.make_build, instances, config, 'build', 2, 1)
+
+        assert_equal([r['instance'] for r in results], instances)
+        assert_equal([r['status'] for r in results], [0, 0])
+        for r in results:
+            assert(os.path.exists(r['log']))
+            with open(r['log']) as f:
+                assert('Created instance' in f.read())
+
+        # A failure in one instance does not affect the others
+        results = bc.make_many(bc.make_test, instances, config, 'test', 2, 1)
+        assert_equal([r['status'] for r in results], [1, 1])
+        assert_equal(
+            results[0]['error'],
+            'Cannot run `make test` before `make image`'
+        )
+    finally:
+        os.chdir(cwd)
+        for instance in instances:
+            for f in bc.instance_files(instance).values():
+                os.unlink(f)
+
+
+def test_backoff():
+    delays = iter(bc.Backoff(1, factor=2, maximum=5))
+    assert_equal([next(delays) for _ in range(5)], [1, 2, 4, 5, 5])
+
+
+def test_wait_until():
+    calls = []
+
+    def check():
+        calls.append(None)
+        return 'done' if len(calls) == 3 else None
+
+    result = bc.wait_until(check, bc.Backoff(0.01, maximum=0.05))
+    assert_equal(result, 'done')
+    assert_equal(len(calls), 3)
+
+    with assert_raises(bc.ConnectionTimeout) as r:
+        bc.wait_until(lambda: None, bc.Backoff(0.01, maximum=0.05),
+                      time.time() + 0.2, bc.ConnectionTimeout('too slow'))
+    assert_equal(r.exception.message, 'too slow')
+
+
+def test_waiter_many():
+    ready = {}
+
+    def check(n):
+        return lambda: n if n in ready else None
+
+    w = bc.waiter()
+    watched = [w.watch(check(n), bc.Backoff(0.01, maximum=0.05))
+               for n in range(100)]
+    for n in range(100):
+        ready[n] = True
+    assert_equal(sorted(f.result(timeout=10) for f in watched), range(100))
+
+
+def test_waiter_blocking():
+    w = bc.Waiter(workers=2, blocking_workers=4)
+    w.start()
+    release = threading.Event()
+
+    def blocked():
+        release.wait(10)
+        return True
+
+    # Blocking checks fill their own pool, not the one for API polls
+    held = [w.watch(blocked, blocking=True) for _ in range(4)]
+    try:
+        assert_equal(w.watch(lambda: 'polled').result(timeout=2), 'polled')
+    finally:
+        release.set()
+    assert_equal([f.result(timeout=10) for f in held], [True] * 4)
+
+
+def test_resource_id_for_cached():
+    bc.clear_caches()
+    calls = []
+
+    class Collection(object):
+        def filter(self, Filters=[]):
+            calls.append(Filters)
+            item = mock.Mock()
+            item.id = 'sg-00000001'
+            return [item]
+
+    args = (Collection(), 'security group', 'web', 'sg-',
+            {'Name': 'group-name', 'Values': ['web']}, 60)
+
+    assert_equal(bc.resource_id_for(*args), 'sg-00000001')
+    assert_equal(bc.resource_id_for(*args), 'sg-00000001')
+    assert_equal(len(calls), 1)
+    assert_equal(bc.resolution_cache().stats(),
+                 {'entries': 1, 'hits': 1, 'misses': 1})
+
+    # The hit is only counted in memory until an entry is next written
+    with open(bc.resolution_cache().path) as f:
+        saved = json.load(f)
+    assert_equal((saved['hits'], saved['misses']), (0, 1))
+
+    # IDs are passed through without a lookup
+    assert_equal(bc.resource_id_for(Collection(), 'security group',
+                                    'sg-00000002', 'sg-', {}, 60),
+                 'sg-00000002')
+    assert_equal(len(calls), 1)
+
+    bc.clear_caches()
+    assert_equal(bc.resource_id_for(*args), 'sg-00000001')
+    assert_equal(len(calls), 2)
+
+
+def test_disk_cache_expires():
+    cache = bc.DiskCache('{}/expiring.json'.format(tempdir))
+    cache.set('key', 'value', -1)
+    assert_equal(cache.get('key'), None)
+    cache.set('key', 'value', 60)
+
+    # The cache persists across instances
+    assert_equal(bc.DiskCache(cache.path).get('key'), 'value')
+
+
+def test_preresolve():
+    bc.clear_caches()
+    config = bc.load_config_v2('tests/resources/boss-v2.yml')
+    instances = sorted(config.keys())
+    config['amz-2015092-default']['build']['security_groups'] = ['web', 'ssh']
+    config['amz-2015092-nginx']['build']['security_groups'] = ['web']
+    config['amz-2015092-nginx']['build']['subnet'] = 'private'
+
+    ec2 = bc.ec2_connect()
+    calls = []
+
+    def resource(ident, **attrs):
+        r = mock.Mock()
+        r.configure_mock(id=ident, **attrs)
+        return r
+
+    def images_filter(Filters=[]):
+        calls.append(Filters)
+        return [resource('ami-0000000{}'.format(i), name=name)
+                for i, name in enumerate(Filters[0]['Values'], 3)]
+
+    def security_groups_filter(Filters=[]):
+        calls.append(Filters)
+        return [resource('sg-00000001', group_name='web'),
+                resource('sg-00000002', group_name='ssh')]
+
+    def subnets_filter(Filters=[]):
+        calls.append(Filters)
+        return [resource('subnet-00000001',
+                         tags=[{'Key': 'Name', 'Value': 'private'}])]
+
+    images_filter_orig = ec2.images.filter
+    ec2.images.filter = images_filter
+    ec2.security_groups.filter = security_groups_filter
+    ec2.subnets.filter = subnets_filter
+    try:
+        bc.preresolve(config, instances)
+        assert_equal(len(calls), 3)
+        assert_equal(calls[1], [{'Name': 'group-name', 'Values': ['ssh', 'web']}])
+
+        assert_equal(len(calls[0][0]['Values']), 2)
+        assert_equal(bc.ami_id_for('amzn-ami-hvm-2015.09.2.x86_64-gp2'),
+                     'ami-00000004')
+        assert_equal(bc.sg_id_for('ssh'), 'sg-00000002')
+        assert_equal(bc.subnet_id_for('private'), 'subnet-00000001')
+        assert_equal(len(calls), 3)
+
+        # Everything is cached, so no further requests are made
+        bc.preresolve(config, instances)
+        assert_equal(len(calls), 3)
+    finally:
+        ec2.images.filter = images_filter_orig
+        bc.clear_caches()
+
+
+def test_load_config_v2_cached():
+    bc.clear_caches()
+    if 'BI_USERNAME' in os.environ: del(os.environ['BI_USERNAME'])
+
+    validate_v2 = bc.validate_v2
+    bc.validate_v2 = probe(validate_v2)
+    try:
+        reset_probes(['validate_v2'])
+        c1 = bc.load_config_v2('tests/resources/boss-v2-env.yml')
+        c2 = bc.load_config_v2('tests/resources/boss-v2-env.yml')
+        assert_equal(probe.called, ['validate_v2'])
+        assert_equal(c1, c2)
+        assert_equal(type(c2['amz-2015092-default']['build']['username']), str)
+
+        # Changing a variable used by the template invalidates the cache
+        os.environ['BI_USERNAME'] = 'shisaboy'
+        c3 = bc.load_config_v2('tests/resources/boss-v2-env.yml')
+        assert_equal(c3['amz-2015092-default']['build']['username'], 'shisaboy')
+        assert_equal(probe.called, ['validate_v2', 'validate_v2'])
+
+        # Other variables do not
+        os.environ['BI_UNRELATED'] = 'x'
+        bc.load_config_v2('tests/resources/boss-v2-env.yml')
+        assert_equal(probe.called, ['validate_v2', 'validate_v2'])
+    finally:
+        bc.validate_v2 = validate_v2
+        for name in ('BI_USERNAME', 'BI_UNRELATED'):
+            if name in os.environ: del(os.environ[name])
+
+
+def test_load_config_v2_cached_types():
+    bc.clear_caches()
+    cwd = os.getcwd()
+    with open('tests/resources/boss-v2.yml') as f:
+        source = f.read()
+    try:
+        os.chdir(tempdir)
+        with open('.boss.yml', 'w') as f:
+            f.write(source.replace(
+                '  - name: default\n',
+                '  - name: default\n'
+                '    extra_vars:\n'
+                '      released: 2017-05-01\n'
+                '      ports: {80: http}\n'))
+        c1 = bc.load_config_v2()
+        c2 = bc.load_config_v2()
+        assert_equal(c1, c2)
+        assert_equal(c2['amz-2015092-default']['build']['extra_vars'], {
+            'released': datetime.date(2017, 5, 1),
+            'ports': {80: 'http'},
+        })
+
+        # Such a configuration does not survive JSON, so it is not cached
+        with open('.boss.yml') as f:
+            assert_equal(bc.cached_config(f.read().decode('utf-8')), None)
+    finally:
+        os.unlink('.boss.yml')
+        os.chdir(cwd)
+        bc.clear_caches()
+
+
+def test_instance_config_lazy():
+    config = bc.load_config_v2('tests/resources/boss-v2.yml')
+
+    assert_equal(sorted(config.keys()), [
+        'amz-2015092-default', 'amz-2015092-nginx',
+        'win-2012r2-default', 'win-2012r2-nginx',
+    ])
+    assert('amz-2015092-nginx' in config)
+    assert('amz-2015092-apache' not in config)
+    assert_equal(config.expanded, {})
+
+    nginx = config['amz-2015092-nginx']
+    assert_equal(config.expanded.keys(), ['amz-2015092-nginx'])
+    assert_equal(nginx['build']['extra_vars'],
+                 {'packages': ['nginx', 'tcpdump']})
+    assert_equal(nginx['build']['iam_instance_profile'], 'LowProfile')
+    assert_equal(nginx['test']['iam_instance_profile'], 'HighProfile')
+    assert_equal(nginx['test']['port'], 22)
+    assert(config['amz-2015092-nginx'] is nginx)
+
+    with assert_raises(KeyError):
+        config['amz-2015092-apache']
+
+
+def test_sqlite_state():
+    instance = 'amz-2015092-sqlite'
+    backend = bc.SqliteState('{}/state.db'.format(tempdir))
+
+    with backend.transaction(instance) as state:
+        assert_equal(state, {})
+        state['keyname'] = 'bossimage-abc'
+        state['build'] = {'id': 'i-00000001', 'ip': '10.20.30.40'}
+
+    assert_equal(backend.load(instance), {
+        'keyname': 'bossimage-abc',
+        'build': {'id': 'i-00000001', 'ip': '10.20.30.40'},
+    })
+    assert_equal(backend.existing([instance, 'other']), set([instance]))
+
+    # Changes are discarded if the transaction fails
+    with assert_raises(bc.StateError):
+        with backend.transaction(instance) as state:
+            state['image'] = {'id': 'ami-00000001'}
+            raise bc.StateError('failed')
+    assert('image' not in backend.load(instance))
+
+    with backend.transaction(instance) as state:
+        del(state['build'])
+        state['image'] = {'id': 'ami-00000001'}
+    assert_equal(backend.load(instance), {
+        'keyname': 'bossimage-abc',
+        'image': {'id': 'ami-00000001'},
+    })
+
+    # The database is not locked while the state of an instance is held
+    quick = bc.SqliteState(backend.path, timeout=0.1)
+    with backend.transaction(instance) as state:
+        with quick.transaction('amz-2015092-other') as other:
+            other['keyname'] = 'bossimage-def'
+        state['keyname'] = 'bossimage-ghi'
+    assert_equal(backend.load(instance)['keyname'], 'bossimage-ghi')
+    with backend.transaction('amz-2015092-other') as other:
+        other.clear()
+
+    with backend.transaction(instance) as state:
+        state.clear()
+    assert_equal(backend.existing([instance]), set())
+
+
+def test_sqlite_state_import():
+    instance = 'amz-2015092-imported'
+    state_file = bc.instance_files(instance)['state']
+    backend = bc.SqliteState('{}/import.db'.format(tempdir))
+    with open(state_file, 'w') as f:
+        f.write(yaml.safe_dump({'keyname': 'bossimage-xyz',
+                                'build': {'id': 'i-00000002', 'ip': '10.0.0.1'}}))
+
+    assert_equal(backend.load(instance)['keyname'], 'bossimage-xyz')
+
+    with backend.transaction(instance) as state:
+        assert_equal(state['build']['id'], 'i-00000002')
+
+    assert(not os.path.exists(state_file))
+    assert_equal(backend.load(instance)['build'],
+                 {'id': 'i-00000002', 'ip': '10.0.0.1'})
+
+
+def test_instance_lock():
+    instance = 'amz-2015092-locked'
+    locked = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with bc.instance_lock(instance):
+            locked.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    locked.wait()
+    lock_timeout = bc.LOCK_TIMEOUT
+    bc.LOCK_TIMEOUT = 0.2
+    try:
+        with assert_raises(bc.LockTimeout):
+            with bc.load_state(instance):
+                pass
+    finally:
+        bc.LOCK_TIMEOUT = lock_timeout
+        release.set()
+        holder.join()
+
+    # The lock may be taken again by the thread which holds it
+    with bc.instance_lock(instance):
+        with bc.load_state(instance) as state:
+            state['keyname'] = 'bossimage-locked'
+    with bc.load_inventory(instance) as inventory:
+        inventory['build'] = 'locked'
+
+    for f in bc.instance_files(instance).values():
+        if os.path.exists(f):
+            os.unlink(f)
+
+
+def test_galaxy_roles():
+    bc.clear_caches()
+    requirements = '{}/requirements.yml'.format(tempdir)
+    with open(requirements, 'w') as f:
+        f.write('- src: cloudboss.java\n')
+
+    installs = []
+
+    def install_roles(requirements, roles_path, verbosity, env):
+        installs.append(requirements)
+        os.mkdir('{}/cloudboss.java'.format(roles_path))
+        return 0
+
+    orig_install_roles = bc.install_roles
+    bc.install_roles = install_roles
+    try:
+        path1, ret1 = bc.galaxy_roles(requirements, 0, {})
+        path2, ret2 = bc.galaxy_roles(requirements, 0, {})
+        assert_equal((ret1, ret2), (0, 0))
+        assert_equal(path1, path2)
+        assert(path1.startswith(bc.cache_dir()))
+        assert(os.path.exists('{}/cloudboss.java'.format(path1)))
+        assert_equal(installs, [requirements])
+
+        # A change to the requirements installs into a new directory
+        with open(requirements, 'a') as f:
+            f.write('- src: cloudboss.python\n')
+        path3, _ = bc.galaxy_roles(requirements, 0, {})
+        assert(path3 != path1)
+        assert_equal(len(installs), 2)
+
+        # Failed installs are not cached
+        bc.install_roles = lambda *args: 1
+        with open(requirements, 'a') as f:
+            f.write('- src: cloudboss.broken\n')
+        path4, ret4 = bc.galaxy_roles(requirements, 0, {})
+        assert_equal(ret4, 1)
+        assert(not os.path.exists(path4))
+    finally:
+        bc.install_roles = orig_install_roles
+        os.unlink(requirements)
+
+
+def test_make_build_reuses_image():
+    config = bc.load_config_v2('tests/resources/boss-v2.yml')
+    instance = 'amz-2015092-nginx'
+    build_config = config[instance]['build']
+    for f in bc.instance_files(instance).values():
+        if os.path.exists(f):
+            os.unlink(f)
+
+    fingerprint = bc.build_fingerprint(build_config, 'ami-00000002')
+    assert_equal(fingerprint, bc.build_fingerprint(build_config, 'ami-00000002'))
+    assert(fingerprint != bc.build_fingerprint(build_config, 'ami-00000003'))
+    assert(fingerprint != bc.build_fingerprint(
+        config['amz-2015092-default']['build'], 'ami-00000002'))
+
+    filters = []
+    bc.clear_caches()
+
+    def images_filter(ImageIds='', Owners=[], Filters=[]):
+        filters.append((Owners, Filters))
+        image = mock.Mock()
+        image.configure_mock(id='ami-00000009', state='available',
+                             creation_date='2017-05-01T00:00:00.000Z')
+        yield image
+
+    ec2 = bc.ec2_connect()
+    images_filter_orig = ec2.images.filter
+    ec2.images.filter = images_filter
+    try:
+        reset_probes(['create_keypair', 'create_instance_v2', 'run_ansible'])
+        assert_equal(bc.make_build(instance, build_config, 1), 0)
+        # No keypair is made for a build which is skipped
+        assert_equal(probe.called, [])
+        # The source AMI name was also resolved by the patched filter
+        fingerprint = bc.build_fingerprint(build_config, 'ami-00000009')
+        assert_equal(filters[-1], (['self'], [{
+            'Name': 'tag:bossimage:fingerprint', 'Values': [fingerprint],
+        }]))
+        with bc.load_state(instance) as state:
+            assert_equal(state['image'], {
+                'id': 'ami-00000009',
+                'fingerprint': fingerprint,
+                'reused': True,
+            })
+            assert('keyname' not in state)
+
+        # A second run also skips the build
+        reset_probes(['create_keypair', 'create_instance_v2', 'run_ansible'])
+        bc.make_build(instance, build_config, 1)
+        assert_equal(probe.called, [])
+
+        # Testing the reused image makes the keypair the test needs
+        reset_probes(['create_keypair', 'create_instance_v2'])
+        bc.make_test(instance, config[instance]['test'], 1)
+        assert_equal(probe.called, ['create_keypair', 'create_instance_v2'])
+        bc.clean_test(instance)
+
+        # Cleaning a reused image only forgets it, and deletes any keypair
+        # left by an earlier version
+        client = ec2.meta.client
+        client.deregister_image = mock.Mock()
+        ec2.KeyPair.reset_mock()
+        with bc.load_state(instance) as state:
+            state['keyname'] = 'bossimage-left'
+        bc.clean_image(instance)
+        assert_equal(client.deregister_image.call_count, 0)
+        ec2.KeyPair.assert_called_once_with(name='bossimage-left')
+        with bc.load_state(instance) as state:
+            assert_equal(state, {})
+            state['image'] = {'id': 'ami-00000009', 'reused': True}
+
+        # Unless it is forced, which needs a new keypair as the cleaning
+        # removed the instance's files
+        reset_probes(['create_keypair', 'create_instance_v2', 'run_ansible'])
+        bc.make_build(instance, build_config, 1, force=True)
+        assert_equal(probe.called,
+                     ['create_keypair', 'create_instance_v2', 'run_ansible'])
+
+        # and then a new image is made rather than the same one reused
+        bc.make_image(instance, config[instance]['image'], False)
+        with bc.load_state(instance) as state:
+            assert_equal(state['build']['force'], True)
+            assert_equal(state['image'], {
+                'id': 'ami-00000001', 'fingerprint': fingerprint})
+    finally:
+        ec2.images.filter = images_filter_orig
+        bc.clear_caches()
+        for f in bc.instance_files(instance).values():
+            if os.path.exists(f):
+                os.unlink(f)
+
+
+def test_build_layers():
+    layers = [
+        {'name': 'base', 'playbook': 'tests/resources/boss-v2.yml',
+         'extra_vars': {}, 'inputs': []},
+        {'name': 'runtime', 'playbook': 'tests/resources/boss-v2-env.yml',
+         'extra_vars': {'version': 1}, 'inputs': []},
+    ]
+    build = bc.load_config_v2('tests/resources/boss-v2.yml')[
+        'amz-2015092-default']['build']
+    config = dict(build, layers=layers)
+
+    def fingerprint_of(layer, parent, **settings):
+        return bc.layer_fingerprint(dict(config, **settings), layer, parent)
+
+    fingerprint = fingerprint_of(layers[0], 'ami-00000001')
+    assert_equal(fingerprint, fingerprint_of(layers[0], 'ami-00000001'))
+    assert(fingerprint != fingerprint_of(layers[0], 'ami-00000002'))
+    assert(fingerprint != fingerprint_of(
+        dict(layers[0], extra_vars={'a': 1}), 'ami-00000001'))
+    # The settings the layer instance is launched with are included
+    assert(fingerprint != fingerprint_of(
+        layers[0], 'ami-00000001', instance_type='m4.large'))
+    assert(fingerprint != fingerprint_of(
+        layers[0], 'ami-00000001', user_data='#!/bin/sh'))
+    assert(fingerprint != fingerprint_of(
+        layers[0], 'ami-00000001', block_device_mappings=[]))
+    # but not those of the profile
+    assert_equal(fingerprint, fingerprint_of(
+        layers[0], 'ami-00000001', extra_vars={'a': 1}))
+
+    built = []
+
+    def find_image(ec2, fingerprint):
+        if fingerprint == fingerprint_of(layers[0], 'ami-00000001'):
+            return mock.Mock(id='ami-00000010')
+
+    def make_layer(config, layer, parent, fingerprint, verbosity):
+        built.append((layer['name'], parent, fingerprint))
+        return 'ami-00000011'
+
+    find_image_orig, make_layer_orig = bc.find_image, bc.make_layer
+    bc.find_image, bc.make_layer = find_image, make_layer
+    try:
+        assert_equal(bc.build_layers(config, 'ami-00000001', 1),
+                     'ami-00000011')
+        assert_equal(built, [(
+            'runtime', 'ami-00000010',
+            fingerprint_of(layers[1], 'ami-00000010'),
+        )])
+    finally:
+        bc.find_image, bc.make_layer = find_image_orig, make_layer_orig
+
+
+def test_build_layers_fanout():
+    config = bc.load_config_v2('tests/resources/boss-v2.yml')
+    default = dict(config['amz-2015092-default']['build'], fanout=True)
+    nginx = dict(config['amz-2015092-nginx']['build'], fanout=True)
+    assert(default['extra_vars'] != nginx['extra_vars'])
+
+    built = []
+
+    def make_layer(config, layer, parent, fingerprint, verbosity):
+        built.append((layer, fingerprint))
+        return 'ami-00000012'
+
+    find_image_orig, make_layer_orig = bc.find_image, bc.make_layer
+    bc.find_image = lambda ec2, fingerprint: None
+    bc.make_layer = make_layer
+    try:
+        assert_equal(bc.build_layers(default, 'ami-00000001', 1),
+                     'ami-00000012')
+        bc.build_layers(nginx, 'ami-00000001', 1)
+    finally:
+        bc.find_image, bc.make_layer = find_image_orig, make_layer_orig
+        os.unlink(bc.instance_files('amz-2015092-base')['playbook'])
+
+    # Both profiles share the same base layer
+    assert_equal(built[0], built[1])
+    assert_equal(built[0][0]['extra_vars'], {})
+
+
+def test_write_ansible_config():
+    path = '{}/ansible.cfg'.format(tempdir)
+    bc.write_ansible_config(path, '.boss/facts', {'ansible_config': {
+        'defaults': {'forks': 20},
+        'ssh_connection': {'pipelining': False},
+    }})
+
+    parser = ConfigParser.RawConfigParser()
+    parser.read(path)
+    assert_equal(parser.get('defaults', 'forks'), '20')
+    assert_equal(parser.get('defaults', 'fact_caching'), 'jsonfile')
+    assert_equal(parser.get('defaults', 'fact_caching_connection'),
+                 os.path.abspath('.boss/facts'))
+    assert_equal(parser.get('ssh_connection', 'pipelining'), 'False')
+    assert('ControlPersist' in parser.get('ssh_connection', 'ssh_args'))
+    os.unlink(path)
+
+
+def test_write_ansible_config_project():
+    path = '{}/instance-ansible.cfg'.format(tempdir)
+    cwd = os.getcwd()
+    try:
+        os.chdir(tempdir)
+        with open('ansible.cfg', 'w') as f:
+            f.write('[defaults]\n'
+                    'forks = 5\n'
+                    'gathering = explicit\n'
+                    'vault_password_file = /etc/vault\n'
+                    '[privilege_escalation]\n'
+                    'become = True\n')
+        bc.write_ansible_config(path, '.boss/facts', {'ansible_config': {
+            'defaults': {'forks': 20},
+        }})
+    finally:
+        os.unlink('ansible.cfg')
+        os.chdir(cwd)
+
+    # The project's options replace the defaults, and are replaced in
+    # turn by those in the configuration
+    parser = ConfigParser.RawConfigParser()
+    parser.read(path)
+    assert_equal(parser.get('defaults', 'forks'), '20')
+    assert_equal(parser.get('defaults', 'gathering'), 'explicit')
+    assert_equal(parser.get('defaults', 'vault_password_file'), '/etc/vault')
+    assert_equal(parser.get('defaults', 'fact_caching'), 'jsonfile')
+    assert_equal(parser.get('privilege_escalation', 'become'), 'True')
+    os.unlink(path)
+
+
+def test_ensure_inventory_purges_facts():
+    config = bc.load_config_v2('tests/resources/boss-v2.yml')
+    instance = 'amz-2015092-facts'
+    facts = bc.facts_dir(instance)
+    os.makedirs(facts)
+    for host in ('10.0.0.1', '10.0.0.2'):
+        with open(os.path.join(facts, host), 'w') as f:
+            f.write('{}')
+
+    bc.ensure_inventory(instance, 'build', config['amz-2015092-default']['build'],
+                        'keyfile', 'i-00000001', '10.0.0.1')
+
+    # Only the facts of the host being provisioned are stale
+    assert_equal(os.listdir(facts), ['10.0.0.2'])
+    shutil.rmtree(facts)
+    bc.delete_files(bc.instance_files(instance))
+
+
+def test_ssh_ready():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    port = server.getsockname()[1]
+
+    # Nothing is listening yet
+    reason = bc.ssh_ready('127.0.0.1', port, 'ec2-user', None, timeout=1)
+    assert(reason.startswith('connection failed'))
+
+    # Something is listening, but it does not speak SSH
+    server.listen(1)
+
+    def accept():
+        conn, _ = server.accept()
+        conn.sendall('HTTP/1.1 400 Bad Request\r\n\r\n')
+        conn.close()
+    thread = threading.Thread(target=accept)
+    thread.start()
+    reason = bc.ssh_ready('127.0.0.1', port, 'ec2-user', None, timeout=1)
+    assert(reason.startswith('ssh error'))
+    thread.join()
+    server.close()
+
+
+def test_inventory_vars():
+    entry = bc.inventory_entry(
+        '10.0.0.1', '.boss/a.pem', 'ec2-user', None, 22, 'ssh')
+    assert_equal(bc.inventory_vars(entry), {
+        'ansible_ssh_private_key_file': '.boss/a.pem',
+        'ansible_user': 'ec2-user',
+        'ansible_password': 'None',
+        'ansible_port': '22',
+        'ansible_connection': 'ssh',
+    })
+
+
+def test_decrypt_password():
+    key = rsa.generate_private_key(65537, 2048, default_backend())
+    keyfile = '{}/password.pem'.format(tempdir)
+    with open(keyfile, 'wb') as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption(),
+        ))
+    encrypted = base64.b64encode(
+        key.public_key().encrypt('hunter2', padding.PKCS1v15()))
+    assert_equal(bc.decrypt_password(encrypted, keyfile), 'hunter2')
+    os.unlink(keyfile)
+
+
+def test_winrm_ready():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    port = server.getsockname()[1]
+    reason = bc.winrm_ready('127.0.0.1', port, 'Administrator', 'x', 1)
+    assert(reason.startswith('connection failed'))
+    server.close()
+
+
+def test_boot_failure():
+    def instance(state='running', impaired=False, output=''):
+        status = 'impaired' if impaired else 'ok'
+        i = mock.Mock()
+        i.configure_mock(id='i-00000001', state={'Name': state},
+                         state_reason={'Message': 'Server.InternalError'})
+        i.meta.client.describe_instance_status.return_value = {
+            'InstanceStatuses': [{
+                'SystemStatus': {'Status': 'ok'},
+                'InstanceStatus': {'Status': status, 'Details': [
+                    {'Name': 'reachability', 'Status': status}]},
+            }],
+        }
+        i.console_output.return_value = {'Output': output}
+        return i
+
+    assert_equal(bc.boot_failure(instance(output='login: ')), None)
+    # A service which systemd restarts from is not a failure to boot
+    assert_equal(bc.boot_failure(instance(
+        output='[FAILED] Failed to start OpenSSH server daemon.\r\n')), None)
+    assert_equal(bc.boot_failure(instance('terminated')),
+                 'instance is terminated (Server.InternalError)')
+    assert_equal(bc.boot_failure(instance(impaired=True)),
+                 'InstanceStatus check is impaired (reachability: impaired)')
+    assert_equal(bc.boot_failure(instance(output='ok\r\n[ 1.0] Kernel panic - '
+                                          'not syncing: VFS\r\n')),
+                 'console output shows "[ 1.0] Kernel panic - not syncing: VFS"')
+
+    i = instance()
+    i.reload.side_effect = ClientError(
+        {'Error': {'Code': 'InvalidInstanceID.NotFound'}}, 'DescribeInstances')
+    assert_equal(bc.boot_failure(i), None)
+
+
+def test_timings():
+    instance = 'timings-default'
+
+    @bc.timed_command('build')
+    def build(instance, fail=False):
+        with bc.timed('launch'):
+            pass
+        with bc.timed('playbook'):
+            if fail:
+                raise bc.StateError('failed')
+
+    build(instance)
+    with assert_raises(bc.StateError):
+        build(instance, fail=True)
+
+    runs = bc.load_timings(instance)
+    assert_equal(len(runs), 2)
+    assert_equal([r['command'] for r in runs], ['build', 'build'])
+    assert_equal([s['name'] for s in runs[0]['steps']], ['launch', 'playbook'])
+    assert('error' not in runs[0])
+    assert_equal(runs[1]['error'], 'StateError')
+
+    stats = bc.aggregate_timings(runs)
+    assert_equal(sorted(stats), [
+        ('build', 'launch'), ('build', 'playbook'), ('build', 'total')])
+    assert_equal(stats[('build', 'total')]['count'], 2)
+
+    # Steps outside of a timed command are not recorded
+    with bc.timed('launch'):
+        pass
+    assert_equal(len(bc.load_timings(instance)), 2)
+    os.unlink(bc.timings_file(instance))
+
+
+def test_api_metrics():
+    metrics = bc.ApiMetrics()
+    session = boto3.Session(region_name='us-east-1', aws_access_key_id='a',
+                            aws_secret_access_key='b')
+    metrics.register(session.events)
+    client = session.client('ec2')
+    stubber = Stubber(client)
+    stubber.add_response('describe_images', {'Images': []})
+    stubber.add_client_error('describe_images', 'InvalidAMIID.Malformed')
+
+    @bc.timed_command('build')
+    def build(instance):
+        client.describe_images()
+        with assert_raises(ClientError):
+            client.describe_images()
+        # A throttled attempt which was retried
+        operation = client.meta.service_model.operation_model('DescribeImages')
+        metrics.needs_retry(
+            ({}, {'Error': {'Code': 'RequestLimitExceeded'}}), operation)
+
+    with stubber:
+        build('api-default')
+
+    (op,) = metrics.summary()
+    assert_equal(op['operation'], 'DescribeImages')
+    assert_equal(op['calls'], 2)
+    assert_equal(op['errors'], 1)
+    assert_equal(op['throttled'], 1)
+    assert_equal(sum(op['histogram']), 2)
+    assert_equal(op['p90'], 0.1)
+
+    (run,) = bc.load_timings('api-default')
+    assert_equal(run['api'], {'calls': 2, 'throttled': 1})
+    os.unlink(bc.timings_file('api-default'))
+
+
+def test_token_bucket():
+    bucket = bc.TokenBucket(20, 2)
+    start = time.time()
+    for _ in range(4):
+        bucket.acquire()
+    # Two at once, then two more at 20 per second
+    elapsed = time.time() - start
+    assert(0.08 < elapsed < 0.5)
+
+    bucket.throttled()
+    assert_equal(bucket.rate, 10)
+    for _ in range(5):
+        bucket.throttled()
+    assert_equal(bucket.rate, 2)
+    for _ in range(30):
+        bucket.succeeded()
+    assert_equal(bucket.rate, 20)
+
+
+def test_rate_limiter():
+    assert_equal(bc.api_family('DescribeImages'), 'describe')
+    assert_equal(bc.api_family('CreateImage'), 'create_image')
+    assert_equal(bc.api_family('RunInstances'), 'mutate')
+
+    os.environ['BI_API_RATE_MUTATE'] = '2:4'
+    try:
+        rates = bc.api_rates()
+    finally:
+        del os.environ['BI_API_RATE_MUTATE']
+    assert_equal(rates['mutate'], (2, 4))
+
+    # A burst below one token would never allow a call
+    os.environ['BI_API_RATE_CREATE_IMAGE'] = '0.5'
+    try:
+        assert_equal(bc.api_rates()['create_image'], (0.5, 1))
+        for value in ('0', '-1:5', '2:0.5', 'fast'):
+            os.environ['BI_API_RATE_CREATE_IMAGE'] = value
+            with assert_raises(bc.ConfigurationError):
+                bc.api_rates()
+    finally:
+        del os.environ['BI_API_RATE_CREATE_IMAGE']
+    assert_equal(rates['describe'], bc.API_RATES['describe'])
+
+    limiter = bc.RateLimiter(rates)
+    operation = mock.Mock()
+    operation.name = 'RunInstances'
+    throttled = ({}, {'Error': {'Code': 'RequestLimitExceeded'}})
+    failed = ({}, {'Error': {'Code': 'InvalidAMIID.NotFound'}})
+
+    # Other errors are left to botocore
+    assert_equal(limiter.needs_retry(failed, operation, 1), None)
+    # Throttled calls are retried, slowing down their family
+    assert_equal(limiter.needs_retry(throttled, operation, 1), 0)
+    assert_equal(limiter.buckets['mutate'].rate, 1)
+    assert_equal(limiter.buckets['describe'].rate, 20)
+    # Until the retries run out
+    assert_equal(limiter.needs_retry(throttled, operation, 5), None)
+
+
+def test_rate_limiter_metrics():
+    metrics = bc.ApiMetrics()
+    session = boto3.Session(region_name='us-east-1', aws_access_key_id='a',
+                            aws_secret_access_key='b')
+    metrics.register(session.events)
+    bc.RateLimiter(bc.API_RATES, metrics).register(session.events)
+    client = session.client('ec2')
+    operation = client.meta.service_model.operation_model('DescribeImages')
+    throttled = (mock.Mock(status_code=503, headers={}),
+                 {'Error': {'Code': 'RequestLimitExceeded'}})
+
+    retry_base = bc.RETRY_BASE
+    bc.RETRY_BASE = 0.001
+    try:
+        # Every throttled attempt is counted, whether the limiter or
+        # botocore decides that it is retried or given up
+        for attempts in range(1, 6):
+            client.meta.events.emit_until_response(
+                'needs-retry.ec2.DescribeImages', response=throttled,
+                endpoint=client._endpoint, operation=operation,
+                attempts=attempts, caught_exception=None, request_dict={})
+    finally:
+        bc.RETRY_BASE = retry_base
+
+    (op,) = metrics.summary()
+    assert_equal(op['throttled'], 5)
+
+
+def test_session_pool():
+    created = []
+
+    class Pool(bc.SessionPool):
+        def create(self, region, role_arn):
+            created.append((region, role_arn))
+            time.sleep(0.1)
+            return object()
+
+    pool = Pool(size=2)
+    entries = []
+    threads = [threading.Thread(target=lambda: entries.append(
+        pool.get('us-west-2'))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Created once, however many threads need it at once
+    assert_equal(created, [('us-west-2', None)])
+    assert_equal(len(set(entries)), 1)
+
+    role = 'arn:aws:iam::000000000001:role/build'
+    assert(pool.get('us-west-2', role) is not entries[0])
+    pool.get('us-west-2')
+    pool.get('eu-west-1')
+    # The least recently used entry was dropped
+    assert_equal(list(pool.entries), [
+        ('us-west-2', None), ('eu-west-1', None)])
+
+
+def test_session_target():
+    targets = []
+
+    @bc.targeted
+    def command(instance, config):
+        targets.append(bc.current_target())
+
+    assert_equal(bc.current_target(), (None, None))
+    with bc.session_target('eu-west-1'):
+        assert_equal(bc.current_target(), ('eu-west-1', None))
+        thread = threading.Thread(
+            target=lambda: targets.append(bc.current_target()))
+        thread.start()
+        thread.join()
+    assert_equal(bc.current_target(), (None, None))
+
+    command('target-default', {'region': 'us-west-2', 'role_arn': ''})
+    assert_equal(targets, [(None, None), ('us-west-2', None)])
+
+
+def test_copy_image():
+    instance = 'copy-default'
+    with bc.load_state(instance) as state:
+        state['image'] = {'id': 'ami-00000001'}
+
+    image = mock.Mock()
+    image.configure_mock(
+        id='ami-00000001', name='role.default', description='',
+        tags=[{'Key': 'bossimage:role', 'Value': 'role'}])
+
+    ec2 = bc.ec2_connect()
+    copied, regions = [], []
+
+    def copy_image(**kwargs):
+        copied.append(kwargs)
+        regions.append(bc.current_target()[0])
+        return {'ImageId': 'ami-0000000{}'.format(len(copied) + 1)}
+
+    tagged = []
+
+    def Image(id):
+        def create_tags(Tags):
+            # The copy is in the state before it is tagged, and is not
+            # visible to the API at first
+            with bc.load_state(instance) as state:
+                assert(id in state['image']['copies'].values())
+            tagged.append(id)
+            if tagged.count(id) == 1:
+                raise ClientError({'Error': {'Code': 'InvalidAMIID.NotFound'}},
+                                  'CreateTags')
+
+        copy = mock.Mock()
+        copy.configure_mock(id=id, state='available')
+        copy.create_tags = create_tags
+        return copy
+
+    ec2.meta.client.copy_image = copy_image
+    ec2.meta.client.meta.region_name = 'us-east-1'
+    Image_orig, ec2.Image = ec2.Image, Image
+    try:
+        bc.copy_image(instance, image, ['us-west-2', 'eu-west-1'])
+        assert_equal(regions, ['us-west-2', 'eu-west-1'])
+        assert_equal(copied[0], {
+            'SourceRegion': 'us-east-1', 'SourceImageId': 'ami-00000001',
+            'Name': 'role.default', 'Description': '',
+        })
+        with bc.load_state(instance) as state:
+            assert_equal(state['image']['copies'], {
+                'us-west-2': 'ami-00000002', 'eu-west-1': 'ami-00000003',
+            })
+            assert_equal(state['image']['copied'], ['us-west-2', 'eu-west-1'])
+        assert_equal(tagged, ['ami-00000002', 'ami-00000002',
+                              'ami-00000003', 'ami-00000003'])
+    finally:
+        ec2.Image = Image_orig
+        with bc.load_state(instance) as state:
+            state.clear()
+
+
+def test_clean_image_reused_copies():
+    instance = 'copy-default'
+    with bc.load_state(instance) as state:
+        state['target'] = {'region': None, 'role_arn': None}
+        state['image'] = {
+            'id': 'ami-00000001', 'fingerprint': 'abc', 'reused': True,
+        }
+
+    image = mock.Mock()
+    image.configure_mock(
+        id='ami-00000001', name='role.default', description='',
+        tags=[{'Key': 'bossimage:fingerprint', 'Value': 'abc'}])
+
+    # An image of the same fingerprint is already in eu-west-1 only
+    def find_image(ec2, fingerprint):
+        if bc.current_target()[0] == 'eu-west-1':
+            return mock.Mock(id='ami-00000009', state='available')
+
+    ec2 = bc.ec2_connect()
+    client = ec2.meta.client
+    client.copy_image = lambda **kwargs: {'ImageId': 'ami-00000002'}
+    client.meta.region_name = 'us-east-1'
+    client.describe_images = lambda ImageIds: {'Images': [{
+        'BlockDeviceMappings': []}]}
+    client.deregister_image = mock.Mock()
+    Image_orig, ec2.Image = ec2.Image, lambda id: mock.Mock(
+        id=id, state='available')
+    find_image_orig, bc.find_image = bc.find_image, find_image
+    try:
+        bc.copy_image(instance, image, ['us-west-2', 'eu-west-1'])
+        with bc.load_state(instance) as state:
+            assert_equal(state['image']['copies'], {
+                'us-west-2': 'ami-00000002', 'eu-west-1': 'ami-00000009',
+            })
+            assert_equal(state['image']['copied'], ['us-west-2'])
+
+        # Only the copy made for this instance is deregistered
+        bc.clean_image(instance)
+        assert_equal([c[1]['ImageId'] for c in
+                      client.deregister_image.call_args_list],
+                     ['ami-00000002'])
+        assert_equal(bc.state_backend().load(instance), {})
+    finally:
+        ec2.Image, bc.find_image = Image_orig, find_image_orig
+        with bc.load_state(instance) as state:
+            state.clear()
+
+
+def test_clean_all():
+    states = {
+        'clean-one': {
+            'keyname': 'bossimage-one',
+            'build': {'id': 'i-00000001', 'ip': '10.0.0.1'},
+            'image': {'id': 'ami-00000001',
+                      'copies': {'us-west-2': 'ami-00000002'},
+                      'copied': ['us-west-2']},
+        },
+        'clean-two': {
+            'keyname': 'bossimage-two',
+            'test': {'id': 'i-00000002', 'ip': '10.0.0.2'},
+        },
+    }
+    for instance, instance_state in states.items():
+        with bc.load_state(instance) as state:
+            state.update(instance_state)
+
+    gone = ClientError(
+        {'Error': {'Code': 'InvalidInstanceID.NotFound'}}, 'TerminateInstances')
+    terminated = []
+
+    def terminate_instances(InstanceIds):
+        if len(InstanceIds) > 1:
+            raise gone
+        terminated.append(InstanceIds)
+
+    client = bc.ec2_connect().meta.client
+    client.terminate_instances = terminate_instances
+    client.describe_images = lambda ImageIds: {'Images': [{
+        'BlockDeviceMappings': [
+            {'DeviceName': '/dev/sda1',
+             'Ebs': {'SnapshotId': ImageIds[0].replace('ami', 'snap')}},
+            {'DeviceName': '/dev/sdb', 'VirtualName': 'ephemeral0'},
+        ]}]}
+    client.deregister_image = mock.Mock()
+    client.delete_snapshot = mock.Mock()
+    client.delete_key_pair = mock.Mock(side_effect=[
+        None, ClientError({'Error': {'Code': 'UnauthorizedOperation'}},
+                          'DeleteKeyPair')])
+
+    failed = bc.clean_all(['clean-one', 'clean-two', 'clean-none'], jobs=1)
+
+    # The batch failed on a missing instance, so each was terminated alone
+    assert_equal(terminated, [['i-00000001'], ['i-00000002']])
+    assert_equal(sorted(c[1]['ImageId'] for c in
+                        client.deregister_image.call_args_list),
+                 ['ami-00000001', 'ami-00000002'])
+    assert_equal(sorted(c[1]['SnapshotId'] for c in
+                        client.delete_snapshot.call_args_list),
+                 ['snap-00000001', 'snap-00000002'])
+    assert_equal(failed, ['clean-two'])
+    assert_equal(bc.state_backend().load('clean-one'), {})
+    assert_equal(bc.state_backend().load('clean-two'), states['clean-two'])
+
+    with bc.load_state('clean-two') as state:
+        state.clear()
+    bc.delete_files(bc.instance_files('clean-two'))
+
+
+def test_clean_all_wait():
+    for instance, ident in (('wait-one', 'i-00000001'),
+                            ('wait-gone', 'i-00000002')):
+        with bc.load_state(instance) as state:
+            state['build'] = {'id': ident, 'ip': '10.0.0.1'}
+
+    def terminate_instances(InstanceIds):
+        if 'i-00000002' in InstanceIds:
+            raise ClientError({'Error': {'Code': 'InvalidInstanceID.NotFound'}},
+                              'TerminateInstances')
+
+    described = []
+
+    def instances_filter(InstanceIds=[]):
+        described.append(InstanceIds)
+        if 'i-00000002' in InstanceIds:
+            raise ClientError({'Error': {'Code': 'InvalidInstanceID.NotFound'}},
+                              'DescribeInstances')
+        return [mock.Mock(state={'Name': 'terminated'})]
+
+    ec2 = bc.ec2_connect()
+    ec2.meta.client.terminate_instances = terminate_instances
+    instances_filter_orig = ec2.instances.filter
+    ec2.instances.filter = instances_filter
+    try:
+        failed = bc.clean_all(['wait-one', 'wait-gone'], wait=True, jobs=1)
+    finally:
+        ec2.instances.filter = instances_filter_orig
+
+    # The instance which was already gone is not waited on
+    assert_equal(described, [['i-00000001']])
+    assert_equal(failed, [])
+    assert_equal(bc.state_backend().load('wait-one'), {})
+    assert_equal(bc.state_backend().load('wait-gone'), {})
+
+
+def test_expired_images():
+    def image(id, created, role='r', platform='p', profile='default'):
+        return mock.Mock(id=id, creation_date=created, tags=[
+            {'Key': 'bossimage:role', 'Value': role},
+            {'Key': 'bossimage:platform', 'Value': platform},
+            {'Key': 'bossimage:profile', 'Value': profile},
+        ])
+
+    images = [
+        image('ami-1', '2026-01-01T00:00:00.000Z'),
+        image('ami-2', '2026-01-05T00:00:00.000Z'),
+        image('ami-3', '2026-01-09T00:00:00.000Z'),
+        image('ami-4', '2026-01-02T00:00:00.000Z', profile='other'),
+    ]
+    now = datetime.datetime(2026, 1, 10)
+
+    def expired(**kwargs):
+        return [i.id for i in bc.expired_images(images, now=now, **kwargs)]
+
+    assert_equal(expired(keep=1), ['ami-2', 'ami-1'])
+    assert_equal(expired(days=6), ['ami-1', 'ami-4'])
+    assert_equal(expired(keep=1, days=6), ['ami-1'])
+    assert_equal(expired(keep=2, days=0), ['ami-1'])
+
+
+def test_share_keypairs():
+    config = bc.load_config_v2('tests/resources/boss-v2.yml')
+    instances = ['amz-2015092-default', 'win-2012r2-default']
+
+    # No keypair is made while no instance is launched
+    reset_probes(['create_keypair'])
+    with bc.share_keypairs(config, instances):
+        pass
+    assert_equal(probe.called, [])
+
+    with bc.share_keypairs(config, instances):
+        for instance in instances:
+            with bc.load_state(instance) as state:
+                bc.ensure_keypair(instance, state)
+    assert_equal(probe.called, ['create_keypair'])
+    assert_equal(bc.SharedKeypairs.current, None)
+
+    states = [bc.state_backend().load(instance) for instance in instances]
+    assert_equal(states[0]['keyname'], states[1]['keyname'])
+    assert_equal(states[0]['shared_with'], ['win-2012r2-default'])
+    keys = [open(bc.instance_files(i)['keyfile']).read() for i in instances]
+    assert_equal(keys, ['thiskeyistotallyvalid'] * 2)
+
+    # The keypair is only deleted along with the last instance using it
+    assert_equal(bc.keypair_in_use(states[0]), True)
+    assert_equal(bc.keypair_in_use(states[0], ignore=instances), False)
+    bc.ec2_connect().KeyPair.reset_mock()
+    for instance in instances:
+        with bc.load_state(instance) as state:
+            bc.delete_keypair(state)
+        assert_equal(bc.state_backend().load(instance), {})
+        bc.delete_files(bc.instance_files(instance))
+    assert_equal(bc.ec2_connect().KeyPair.call_count, 1)